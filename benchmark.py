@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+Offline benchmarks for bot.py. No Telegram connection is made.
+
+Profile comparison (default): runs the exact ffmpeg command the bot builds for
+every encode profile on the same clip and reports wall time and output size.
+
+Suite (--suite): times the hot paths on synthetic inputs and writes p50/p99
+latency and throughput per path as JSON, so runs can be compared across commits:
+  - photo watermark (PIL overlay, cold and cached) at several resolutions
+  - video/GIF watermark via ffmpeg on lavfi clips (skipped without ffmpeg)
+  - word replacement with N rules
+  - SQLite helpers on a transferred_posts table with --db-rows rows
+
+Usage:
+    python benchmark.py                      # synthetic 10s 1080p clip with audio
+    python benchmark.py --input sample.mp4   # your own clip
+    python benchmark.py --profiles fast balanced --runs 3
+    python benchmark.py --suite --json results.json
+    python benchmark.py --suite --only replace db --compare baseline.json
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# bot.py reads its credentials at import time; the benchmark never connects
+for key, value in (('API_ID', '1'), ('API_HASH', 'benchmark'), ('BOT_TOKEN', '1:benchmark'), ('ADMIN_ID', '1')):
+    os.environ.setdefault(key, value)
+if 'VIDEO_WATERMARK_FONT' not in os.environ:
+    for name in ('Impact.ttf', 'impact.ttf'):
+        if (ROOT / name).exists():
+            os.environ['VIDEO_WATERMARK_FONT'] = str(ROOT / name)
+            break
+
+sys.path.insert(0, str(ROOT))
+import bot  # noqa: E402
+from PIL import Image  # noqa: E402
+
+SUITE_GROUPS = ('photo', 'video', 'replace', 'db')
+PHOTO_SIZES = ((640, 360), (1280, 720), (1920, 1080), (3840, 2160))
+RULE_COUNTS = (10, 100, 1000)
+
+
+def make_clip(path, seconds, height):
+    width = height * 16 // 9
+    subprocess.check_call([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=30:duration={seconds}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-c:a', 'aac', '-shortest', str(path),
+    ])
+
+
+def run_profile(source, info, name, text, runs, workdir, is_gif=False):
+    profile = bot.ENCODE_PROFILES[name]
+    output = Path(workdir) / f'{name}{"-animation" if is_gif else ""}.mp4'
+    cmd = bot.build_watermark_command(str(source), str(output), text, profile, info, is_gif)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        timings.append(time.perf_counter() - started)
+    return {
+        'profile': name,
+        'seconds': statistics.median(timings),
+        'size': output.stat().st_size,
+    }
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples, items=1, **params):
+    """samples are seconds per call; items is how many units one call handles"""
+    total = sum(samples)
+    return {
+        **params,
+        'n': len(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'throughput_per_s': len(samples) * items / total if total else None,
+    }
+
+
+def time_calls(fn, iterations, setup=None):
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def time_async_calls(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def synthetic_jpeg(width, height, seed):
+    # noise + gradient so JPEG sizes are close to real photos
+    rng = random.Random(seed)
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    image = Image.blend(noise, gradient, 0.5)
+    tint = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    image = Image.blend(image, tint, 0.3)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def bench_photo(results, iterations, text):
+    for width, height in PHOTO_SIZES:
+        data = synthetic_jpeg(width, height, width)
+        conn_id = -width  # an overlay cache slot of its own
+        params = {'resolution': f'{width}x{height}', 'input_bytes': len(data)}
+        cold = time_calls(lambda: bot.watermark_photo(data, conn_id, text), iterations,
+                          setup=lambda: bot.invalidate_watermark_cache(conn_id))
+        results[f'photo_watermark_cold[{width}x{height}]'] = summarize(cold, **params)
+        warm = time_calls(lambda: bot.watermark_photo(data, conn_id, text), iterations)
+        results[f'photo_watermark_cached[{width}x{height}]'] = summarize(warm, **params)
+
+
+def make_gif(path, seconds, height):
+    width = height * 16 // 9
+    subprocess.check_call([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=15:duration={seconds}', str(path),
+    ])
+
+
+def bench_video(results, iterations, text, workdir, seconds, profile_name):
+    if not shutil.which('ffmpeg'):
+        results['video_watermark'] = {'skipped': 'ffmpeg not found in PATH'}
+        return
+    profile = bot.ENCODE_PROFILES[profile_name]
+    clips = [
+        ('mp4', 720, False, make_clip),
+        ('mp4', 1080, False, make_clip),
+        ('gif', 360, True, make_gif),
+    ]
+    for kind, height, is_gif, maker in clips:
+        source = Path(workdir) / f'clip-{height}.{kind}'
+        maker(source, seconds, height)
+        info = asyncio.run(bot.probe_video(str(source)))
+        output = Path(workdir) / f'out-{height}-{kind}.mp4'
+        cmd = bot.build_watermark_command(str(source), str(output), text, profile, info, is_gif)
+        samples = time_calls(lambda: subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE),
+                             iterations)
+        results[f'video_watermark[{kind} {height}p {seconds}s]'] = summarize(
+            samples, profile=profile_name, input_bytes=source.stat().st_size, output_bytes=output.stat().st_size)
+
+
+def synthetic_rules(count, rng):
+    alphabet = 'abcdefghijklmnopqrstuvwxyzابپتثجچحخدذرزسشصضطظعغفقکگلمنوهی'
+    rules = set()
+    while len(rules) < count:
+        rules.add(''.join(rng.choice(alphabet) for _ in range(rng.randint(3, 10))))
+    return [(word, f'<{i}>') for i, word in enumerate(sorted(rules))]
+
+
+def synthetic_text(rules, rng, words=200, hit_rate=0.2):
+    filler = ['channel', 'post', 'کانال', 'پست', 'http://t.me/x', '#tag', '@someone', '12345']
+    return ' '.join(rng.choice(rules)[0] if rng.random() < hit_rate else rng.choice(filler) for _ in range(words))
+
+
+def bench_replace(results, iterations):
+    rng = random.Random(25)
+    for count in RULE_COUNTS:
+        rules = synthetic_rules(count, rng)
+        texts = [synthetic_text(rules, rng) for _ in range(32)]
+        build = time_calls(lambda: bot.WordReplacer(rules), max(3, iterations // 10))
+        results[f'replace_build[{count} rules]'] = summarize(build, rules=count)
+        replacer = bot.WordReplacer(rules)
+        text_cycle = itertools.cycle(texts)
+        apply = time_calls(lambda: replacer.apply(next(text_cycle)), iterations * 10)
+        results[f'replace_apply[{count} rules]'] = summarize(apply, rules=count, text_chars=len(texts[0]))
+
+
+def populate_transferred_posts(path, rows, connections=4):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany('INSERT INTO channel_connections (id, source_channel, destination_channel) VALUES (?, ?, ?)',
+                         [(c, f'@src{c}', f'@dst{c}') for c in range(1, connections + 1)])
+        per_connection = rows // connections
+        for c in range(1, connections + 1):
+            conn.executemany('INSERT INTO transferred_posts (connection_id, source_message_id, destination_message_id) VALUES (?, ?, ?)',
+                             ((c, i, i + 1_000_000) for i in range(1, per_connection + 1)))
+    conn.close()
+    return per_connection
+
+
+def bench_db(results, iterations, rows, workdir):
+    path = str(Path(workdir) / 'bench.db')
+    bot.DB_PATH = path
+    bot.create_database()
+    started = time.perf_counter()
+    per_connection = populate_transferred_posts(path, rows)
+    results['db_populate'] = {'rows': rows, 'seconds': time.perf_counter() - started}
+
+    async def run():
+        bot.db = bot.Database(path)
+        rng = random.Random(7)
+        try:
+            lookup = await time_async_calls(
+                lambda: bot.get_destination_message_id(rng.randint(1, 4), rng.randint(1, per_connection * 2)), iterations * 10)
+            results['db_get_destination_message_id'] = summarize(lookup, rows=rows)
+
+            async def page():
+                start = rng.randint(1, per_connection)
+                await bot.get_transferred_message_ids(1, range(start, start + bot.BACKFILL_PAGE_SIZE))
+            pages = await time_async_calls(page, iterations)
+            results['db_get_transferred_message_ids'] = summarize(pages, items=bot.BACKFILL_PAGE_SIZE, rows=rows,
+                                                                  page=bot.BACKFILL_PAGE_SIZE)
+
+            next_id = iter(range(per_connection * 2 + 1, 1 << 62))
+            async def batch():
+                transfers = [(source, source) for source in (next(next_id) for _ in range(bot.BACKFILL_COMMIT_EVERY))]
+                await bot.save_transfer_progress(2, transfers, [], transfers[-1][0])
+            batches = await time_async_calls(batch, iterations)
+            results['db_save_transfer_progress'] = summarize(batches, items=bot.BACKFILL_COMMIT_EVERY, rows=rows,
+                                                             batch=bot.BACKFILL_COMMIT_EVERY)
+
+            async def single():
+                await bot.save_transferred_post(3, next(next_id), 1)
+            singles = await time_async_calls(single, iterations)
+            results['db_save_transferred_post'] = summarize(singles, rows=rows)
+
+            async def logs():
+                for i in range(bot.ACTIVITY_LOG_BATCH):
+                    bot.activity_log_writer.add(1, 'transfer', f'benchmark {i}')
+                await bot.activity_log_writer.flush()
+            flushes = await time_async_calls(logs, max(3, iterations // 5))
+            results['db_activity_log_flush'] = summarize(flushes, items=bot.ACTIVITY_LOG_BATCH, batch=bot.ACTIVITY_LOG_BATCH)
+        finally:
+            await bot.db.close()
+    asyncio.run(run())
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """prints p50 changes against a previous JSON run; returns the names that regressed"""
+    baseline = json.loads(Path(baseline_path).read_text())['results']
+    regressed = []
+    print(f'\n{"path":<48} {"base p50":>10} {"p50":>10} {"change":>8}', file=sys.stderr)
+    for name, result in results.items():
+        old = baseline.get(name, {}).get('p50_ms')
+        new = result.get('p50_ms')
+        if old is None or new is None:
+            continue
+        change = new / old - 1 if old else 0.0
+        flag = ' REGRESSED' if change > threshold else ''
+        if flag:
+            regressed.append(name)
+        print(f'{name:<48} {old:>10.3f} {new:>10.3f} {change:>+8.0%}{flag}', file=sys.stderr)
+    return regressed
+
+
+def run_suite(args):
+    groups = args.only or SUITE_GROUPS
+    # one profile for the suite: the one given with --profiles, else the bot's default
+    profile_name = args.profiles[0] if len(args.profiles) == 1 else bot.DEFAULT_ENCODE_PROFILE
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        for group in groups:
+            started = time.perf_counter()
+            print(f'Running {group}...', file=sys.stderr)
+            if group == 'photo':
+                bench_photo(results, args.iterations, args.text)
+            elif group == 'video':
+                bench_video(results, args.runs, args.text, workdir, min(args.seconds, 5), profile_name)
+            elif group == 'replace':
+                bench_replace(results, args.iterations)
+            elif group == 'db':
+                bench_db(results, args.iterations, args.db_rows, workdir)
+            print(f'  {group} done in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.json:
+        Path(args.json).write_text(output + '\n')
+        print(f'Wrote {args.json}', file=sys.stderr)
+    else:
+        print(output)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare bot.py encode profiles on one clip, or run the hot-path suite.')
+    parser.add_argument('--input', help='video to encode (default: generated test clip)')
+    parser.add_argument('--seconds', type=int, default=10, help='length of the generated clip')
+    parser.add_argument('--height', type=int, default=1080, help='height of the generated clip')
+    parser.add_argument('--profiles', nargs='+', default=list(bot.ENCODE_PROFILES), choices=list(bot.ENCODE_PROFILES))
+    parser.add_argument('--runs', type=int, default=1, help='runs per profile (median is reported)')
+    parser.add_argument('--text', default='@benchmark', help='watermark text')
+    parser.add_argument('--gif', action='store_true', help='use the animation (GIF) path: silent MP4 at ANIMATION_PRESET or faster')
+    suite = parser.add_argument_group('suite')
+    suite.add_argument('--suite', action='store_true', help='run the hot-path suite and print JSON')
+    suite.add_argument('--only', nargs='+', choices=SUITE_GROUPS, help='suite groups to run (default: all)')
+    suite.add_argument('--iterations', type=int, default=50, help='calls per suite case (replacement runs 10x this)')
+    suite.add_argument('--db-rows', type=int, default=2_000_000, help='rows pre-populated in transferred_posts')
+    suite.add_argument('--json', help='write the suite report to this file instead of stdout')
+    suite.add_argument('--compare', help='previous suite JSON; exit 1 when a p50 regresses beyond --threshold')
+    suite.add_argument('--threshold', type=float, default=0.2, help='allowed p50 slowdown for --compare (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    if args.suite:
+        run_suite(args)
+        return
+
+    if not shutil.which('ffmpeg'):
+        print('ffmpeg not found in PATH.')
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory(prefix='wm-bench-') as workdir:
+        source = Path(args.input) if args.input else Path(workdir) / 'input.mp4'
+        if not args.input:
+            print(f'Generating {args.seconds}s {args.height}p test clip...')
+            make_clip(source, args.seconds, args.height)
+
+        info = asyncio.run(bot.probe_video(str(source)))
+        input_size = source.stat().st_size
+        print(f'Input: {source.name} {info} {input_size / 1024 / 1024:.1f} MB\n')
+        print(f'{"profile":<10} {"seconds":>8} {"size MB":>8} {"vs input":>9}')
+
+        for name in args.profiles:
+            try:
+                result = run_profile(source, info, name, args.text, args.runs, workdir, args.gif)
+            except subprocess.CalledProcessError as e:
+                print(f'{name:<10} failed: {e.stderr.decode(errors="replace").strip()}')
+                continue
+            print(f'{result["profile"]:<10} {result["seconds"]:>8.2f} {result["size"] / 1024 / 1024:>8.2f} '
+                  f'{result["size"] / input_size:>8.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,29 @@
 
 import os
 import io
+import re
 import json
+import hashlib
+import shutil
+import contextlib
+import contextvars
 import sqlite3
 import asyncio
 import logging
 import tempfile
+import threading
+import functools
 import subprocess
-from datetime import datetime
+import time
+from collections import OrderedDict, namedtuple, deque
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from pyrogram import Client, filters, idle
+from pyrogram import Client, filters, idle, raw, utils
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from pyrogram.errors import FloodWait, BadRequest
+from pyrogram.errors import FloodWait, BadRequest, MessageNotModified
 from pyrogram.enums import ChatMemberStatus, ParseMode, ChatType
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto, InputMediaVideo
 
 load_dotenv()
 
@@ -36,9 +46,89 @@ bot = Client("transfer_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOK
 user = Client("user_account", api_id=API_ID, api_hash=API_HASH)
 user_states = {}  # ذخیره وضعیت مرحله به مرحله ادمین‌ها
 
+DB_PATH = 'transfer_bot.db'
+
+class Database:
+    """
+    یک اتصال دائمی SQLite (WAL) که همهٔ کوئری‌ها روی یک ترد اختصاصی اجرا می‌شوند
+    تا حلقهٔ asyncio (و هر دو کلاینت Pyrogram) هیچ‌وقت پشت دیسک منتظر نماند.
+    ماژول sqlite3 دستورات کامپایل‌شده را بر اساس متن SQL کش می‌کند (cached_statements)،
+    پس کوئری‌های ثابت این فایل عملاً prepared statement هستند.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def _connection(self):
+        # فقط داخل ترد دیتابیس صدا زده می‌شود
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._conn = conn
+        return self._conn
+
+    async def _submit(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        with metrics.timer("db"):
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _execute(self, sql, params):
+        conn = self._connection()
+        cursor = conn.execute(sql, params)
+        conn.commit()
+        return cursor.lastrowid
+
+    def _executemany(self, sql, seq):
+        conn = self._connection()
+        conn.executemany(sql, seq)
+        conn.commit()
+
+    def _fetchone(self, sql, params):
+        return self._connection().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _run(self, fn):
+        conn = self._connection()
+        with conn:
+            return fn(conn)
+
+    async def execute(self, sql, params=()):
+        """یک دستور نوشتنی را اجرا و commit می‌کند؛ lastrowid را برمی‌گرداند."""
+        return await self._submit(self._execute, sql, params)
+
+    async def executemany(self, sql, seq):
+        return await self._submit(self._executemany, sql, list(seq))
+
+    async def fetchone(self, sql, params=()):
+        return await self._submit(self._fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self._submit(self._fetchall, sql, params)
+
+    async def run(self, fn):
+        """fn(conn) را داخل یک تراکنش روی ترد دیتابیس اجرا می‌کند."""
+        return await self._submit(self._run, fn)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        await self._submit(self._close)
+        self._executor.shutdown(wait=True)
+
+db = Database(DB_PATH)
+
 # ایجاد دیتابیس SQLite
 def create_database():
-    conn = sqlite3.connect('transfer_bot.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
     # جداول اصلی
@@ -89,6 +179,62 @@ def create_database():
     )
     ''')
 
+    # file_id خروجی‌های آپلودشده تا رسانهٔ تکراری دوباره پردازش و آپلود نشود
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS uploaded_media (
+        source_unique_id TEXT NOT NULL,
+        watermark_hash TEXT NOT NULL,
+        media_kind TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (source_unique_id, watermark_hash, media_kind)
+    )
+    ''')
+
+    # شمارندهٔ ساعتی فعالیت‌ها برای هر اتصال؛ بعد از پاک شدن لاگ‌های قدیمی هم باقی می‌ماند
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS activity_rollups (
+        connection_id INTEGER NOT NULL,
+        hour TEXT NOT NULL,
+        action_type TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (connection_id, hour, action_type)
+    )
+    ''')
+
+    # کارهای بک‌فیل با نقطهٔ بازیابی (cursor) تا بعد از توقف یا ری‌استارت از همان‌جا ادامه دهند
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS backfill_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        connection_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor_message_id INTEGER DEFAULT 0,
+        target_message_id INTEGER DEFAULT 0,
+        scanned_count INTEGER DEFAULT 0,
+        transferred_count INTEGER DEFAULT 0,
+        failed_count INTEGER DEFAULT 0,
+        rate REAL DEFAULT 0,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP,
+        FOREIGN KEY (connection_id) REFERENCES channel_connections (id) ON DELETE CASCADE
+    )
+    ''')
+
+    # کش resolve کانال‌ها (username/لینک -> chat_id) تا بعد از ری‌استارت دوباره از شبکه پرسیده نشوند
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS peer_cache (
+        ref TEXT PRIMARY KEY,
+        chat_id INTEGER,
+        username TEXT,
+        title TEXT,
+        access_hash INTEGER,
+        resolved_at REAL NOT NULL,
+        error TEXT
+    )
+    ''')
+
     # مهاجرتِ امن برای نسخه‌های قدیمی
     def _safe_alter(sql):
         try:
@@ -99,99 +245,226 @@ def create_database():
     _safe_alter("ALTER TABLE channel_connections ADD COLUMN is_active INTEGER DEFAULT 1")
     _safe_alter("ALTER TABLE channel_connections ADD COLUMN last_scanned_message_id INTEGER DEFAULT 0")
     _safe_alter("ALTER TABLE channel_connections ADD COLUMN is_restricted INTEGER DEFAULT 0")
+    _safe_alter("ALTER TABLE channel_connections ADD COLUMN encode_profile TEXT")
     _safe_alter("CREATE UNIQUE INDEX IF NOT EXISTS idx_transferred_unique ON transferred_posts(connection_id, source_message_id)")
+    _safe_alter("CREATE INDEX IF NOT EXISTS idx_activity_logs_created ON activity_logs(created_at)")
 
     conn.commit()
     conn.close()
 
 # توابع دیتابیس
-def add_channel_connection(source, destination):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO channel_connections (source_channel, destination_channel) VALUES (?, ?)", 
-                  (source, destination))
-    connection_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+async def add_channel_connection(source, destination):
+    connection_id = await db.execute("INSERT INTO channel_connections (source_channel, destination_channel) VALUES (?, ?)",
+                                     (source, destination))
+    invalidate_routing_index()
     return connection_id
 
-def get_all_connections():
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, source_channel, destination_channel FROM channel_connections")
-    connections = cursor.fetchall()
-    conn.close()
-    return connections
+async def get_all_connections():
+    return await db.fetchall("SELECT id, source_channel, destination_channel FROM channel_connections")
 
-def delete_connection(connection_id):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM channel_connections WHERE id = ?", (connection_id,))
-    conn.commit()
-    conn.close()
+async def delete_connection(connection_id):
+    channels = await get_connection_channels(connection_id)
+    await db.execute("DELETE FROM channel_connections WHERE id = ?", (connection_id,))
+    invalidate_routing_index()
+    if channels:
+        await invalidate_peer(*channels)
 
-def add_word_replacement(connection_id, original_word, replacement_word):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO word_replacements (connection_id, original_word, replacement_word) VALUES (?, ?, ?)",
-                  (connection_id, original_word, replacement_word))
-    conn.commit()
-    conn.close()
+async def add_word_replacement(connection_id, original_word, replacement_word):
+    await db.execute("INSERT INTO word_replacements (connection_id, original_word, replacement_word) VALUES (?, ?, ?)",
+                     (connection_id, original_word, replacement_word))
+    invalidate_word_replacer(connection_id)
 
-def get_word_replacements(connection_id):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT original_word, replacement_word FROM word_replacements WHERE connection_id = ?", 
-                  (connection_id,))
-    replacements = cursor.fetchall()
-    conn.close()
-    return replacements
+async def get_word_replacements(connection_id):
+    return await db.fetchall("SELECT original_word, replacement_word FROM word_replacements WHERE connection_id = ?",
+                             (connection_id,))
 
-def clear_word_replacements(connection_id):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM word_replacements WHERE connection_id = ?", (connection_id,))
-    conn.commit()
-    conn.close()
+async def clear_word_replacements(connection_id):
+    await db.execute("DELETE FROM word_replacements WHERE connection_id = ?", (connection_id,))
+    invalidate_word_replacer(connection_id)
 
-def save_transferred_post(connection_id, source_message_id, destination_message_id):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO transferred_posts (connection_id, source_message_id, destination_message_id) VALUES (?, ?, ?)",
-                  (connection_id, source_message_id, destination_message_id))
-    conn.commit()
-    conn.close()
+async def delete_word_replacement(word_id, connection_id):
+    await db.execute("DELETE FROM word_replacements WHERE id = ?", (word_id,))
+    invalidate_word_replacer(connection_id)
 
-def get_destination_message_id(connection_id, source_message_id):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT destination_message_id FROM transferred_posts WHERE connection_id = ? AND source_message_id = ?",
-                  (connection_id, source_message_id))
-    result = cursor.fetchone()
-    conn.close()
+async def save_transferred_post(connection_id, source_message_id, destination_message_id):
+    await db.execute("INSERT OR IGNORE INTO transferred_posts (connection_id, source_message_id, destination_message_id) VALUES (?, ?, ?)",
+                     (connection_id, source_message_id, destination_message_id))
+
+async def get_destination_message_id(connection_id, source_message_id):
+    result = await db.fetchone("SELECT destination_message_id FROM transferred_posts WHERE connection_id = ? AND source_message_id = ?",
+                               (connection_id, source_message_id))
     return result[0] if result else None
 
-def add_activity_log(connection_id, action_type, details):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO activity_logs (connection_id, action_type, details) VALUES (?, ?, ?)",
-                  (connection_id, action_type, details))
-    conn.commit()
-    conn.close()
+async def get_transferred_message_ids(connection_id, source_message_ids):
+    """از بین source_message_ids آنهایی که قبلا منتقل شده‌اند را با یک کوئری برمی‌گرداند: {source: destination}"""
+    ids = [int(i) for i in source_message_ids]
+    if not ids:
+        return {}
+    placeholders = ",".join("?" * len(ids))
+    rows = await db.fetchall(f"SELECT source_message_id, destination_message_id FROM transferred_posts "
+                             f"WHERE connection_id = ? AND source_message_id IN ({placeholders})",
+                             (connection_id, *ids))
+    return dict(rows)
+
+async def save_transfer_progress(connection_id, transfers, logs, last_scanned_message_id=None, job_checkpoint=None):
+    """
+    پیشرفت یک دسته (transferred_posts، activity_logs، last_scanned و checkpoint کار بک‌فیل) را در یک تراکنش ثبت می‌کند.
+    transfers: [(source_id, destination_id)]، logs: [(action_type, details)]
+    job_checkpoint: {"job_id", "cursor", "scanned", "transferred", "failed", "rate"} (شمارنده‌ها افزایشی‌اند)
+    """
+    def _write(conn):
+        conn.executemany("INSERT OR IGNORE INTO transferred_posts (connection_id, source_message_id, destination_message_id) VALUES (?, ?, ?)",
+                         [(connection_id, src, dst) for src, dst in transfers])
+        if last_scanned_message_id is not None:
+            # بک‌فیل از ابتدا نباید cursor لحظه‌ای اتصال را عقب ببرد
+            conn.execute("UPDATE channel_connections SET last_scanned_message_id = MAX(COALESCE(last_scanned_message_id, 0), ?) WHERE id = ?",
+                         (int(last_scanned_message_id), connection_id))
+        if job_checkpoint:
+            conn.execute("""
+                UPDATE backfill_jobs
+                SET cursor_message_id = MAX(cursor_message_id, ?),
+                    scanned_count = scanned_count + ?,
+                    transferred_count = transferred_count + ?,
+                    failed_count = failed_count + ?,
+                    rate = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (job_checkpoint["cursor"] or 0, job_checkpoint["scanned"], job_checkpoint["transferred"],
+                  job_checkpoint["failed"], job_checkpoint["rate"], job_checkpoint["job_id"]))
+
+    await db.run(_write)
+    for action, details in logs:
+        activity_log_writer.add(connection_id, action, details)
+
+# لاگ فعالیت‌ها در حافظه جمع و هر چند ثانیه در یک تراکنش نوشته می‌شوند
+ACTIVITY_LOG_FLUSH_SECONDS = float(os.getenv("ACTIVITY_LOG_FLUSH_SECONDS", 2))
+ACTIVITY_LOG_BATCH = int(os.getenv("ACTIVITY_LOG_BATCH", 500))
+ACTIVITY_LOG_RETENTION_DAYS = int(os.getenv("ACTIVITY_LOG_RETENTION_DAYS", 30))
+ACTIVITY_LOG_PRUNE_CHUNK = 5000
+ACTIVITY_LOG_PRUNE_INTERVAL = 3600
+
+def _utc_timestamp(moment=None):
+    # همان قالب CURRENT_TIMESTAMP در SQLite
+    return (moment or datetime.now(timezone.utc)).strftime("%Y-%m-%d %H:%M:%S")
+
+class ActivityLogWriter:
+    """
+    add() فقط در بافر می‌گذارد؛ task پس‌زمینه هر ACTIVITY_LOG_FLUSH_SECONDS (یا با پر شدن بافر)
+    همه را با executemany می‌نویسد و شمارندهٔ ساعتی activity_rollups را در همان تراکنش به‌روز می‌کند.
+    لاگ‌های قدیمی‌تر از ACTIVITY_LOG_RETENTION_DAYS تکه‌تکه پاک می‌شوند تا دیتابیس قفل طولانی نگیرد.
+    """
 
-def get_recent_activity_logs(limit=10):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
+    def __init__(self):
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._last_prune = 0.0
+
+    def add(self, connection_id, action_type, details):
+        self._buffer.append((connection_id, action_type, details, _utc_timestamp()))
+        if len(self._buffer) >= ACTIVITY_LOG_BATCH:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+
+        rollups = {}
+        for connection_id, action_type, _, created_at in rows:
+            key = (connection_id or 0, created_at[:13] + ":00", action_type)
+            rollups[key] = rollups.get(key, 0) + 1
+
+        def _write(conn):
+            conn.executemany("INSERT INTO activity_logs (connection_id, action_type, details, created_at) VALUES (?, ?, ?, ?)", rows)
+            conn.executemany("""
+                INSERT INTO activity_rollups (connection_id, hour, action_type, count) VALUES (?, ?, ?, ?)
+                ON CONFLICT(connection_id, hour, action_type) DO UPDATE SET count = count + excluded.count
+            """, [(*key, count) for key, count in rollups.items()])
+
+        try:
+            await db.run(_write)
+        except Exception as e:
+            logger.error(f"⛔️ نوشتن {len(rows)} لاگ فعالیت ناموفق بود: {e}")
+
+    async def prune(self):
+        cutoff = _utc_timestamp(datetime.now(timezone.utc) - timedelta(days=ACTIVITY_LOG_RETENTION_DAYS))
+
+        def _delete_chunk(conn):
+            return conn.execute("""
+                DELETE FROM activity_logs WHERE id IN (
+                    SELECT id FROM activity_logs WHERE created_at < ? LIMIT ?
+                )
+            """, (cutoff, ACTIVITY_LOG_PRUNE_CHUNK)).rowcount
+
+        while await db.run(_delete_chunk) >= ACTIVITY_LOG_PRUNE_CHUNK:
+            # بین تکه‌ها بقیهٔ کوئری‌ها فرصت اجرا پیدا می‌کنند
+            await asyncio.sleep(0.1)
+
+    async def _run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=ACTIVITY_LOG_FLUSH_SECONDS)
+            self._wakeup.clear()
+            await self.flush()
+            if time.monotonic() - self._last_prune >= ACTIVITY_LOG_PRUNE_INTERVAL:
+                self._last_prune = time.monotonic()
+                try:
+                    await self.prune()
+                except Exception as e:
+                    logger.error(f"⛔️ پاک‌سازی لاگ‌های قدیمی ناموفق بود: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+activity_log_writer = ActivityLogWriter()
+
+async def add_activity_log(connection_id, action_type, details):
+    activity_log_writer.add(connection_id, action_type, details)
+
+async def get_recent_activity_logs(limit=10):
+    # لاگ‌های داخل بافر هم دیده شوند
+    await activity_log_writer.flush()
+    return await db.fetchall("""
         SELECT a.id, c.source_channel, c.destination_channel, a.action_type, a.details, a.created_at
         FROM activity_logs a
         JOIN channel_connections c ON a.connection_id = c.id
-        ORDER BY a.created_at DESC
+        ORDER BY a.id DESC
         LIMIT ?
     """, (limit,))
-    logs = cursor.fetchall()
-    conn.close()
-    return logs
+
+async def get_activity_rollups(hours=24):
+    """جمع فعالیت هر اتصال در `hours` ساعت اخیر: [(connection_id, action_type, count)]"""
+    since = _utc_timestamp(datetime.now(timezone.utc) - timedelta(hours=hours))[:13] + ":00"
+    return await db.fetchall("""
+        SELECT connection_id, action_type, SUM(count) FROM activity_rollups
+        WHERE hour >= ? GROUP BY connection_id, action_type
+    """, (since,))
+
+async def get_uploaded_file_id(source_unique_id, watermark_hash, media_kind):
+    row = await db.fetchone("SELECT file_id FROM uploaded_media WHERE source_unique_id = ? AND watermark_hash = ? AND media_kind = ?",
+                            (source_unique_id, watermark_hash, media_kind))
+    return row[0] if row else None
+
+async def save_uploaded_file_id(source_unique_id, watermark_hash, media_kind, file_id):
+    await db.execute("INSERT OR REPLACE INTO uploaded_media (source_unique_id, watermark_hash, media_kind, file_id) VALUES (?, ?, ?, ?)",
+                     (source_unique_id, watermark_hash, media_kind, file_id))
+
+async def delete_uploaded_file_id(source_unique_id, watermark_hash, media_kind):
+    await db.execute("DELETE FROM uploaded_media WHERE source_unique_id = ? AND watermark_hash = ? AND media_kind = ?",
+                     (source_unique_id, watermark_hash, media_kind))
+
+async def get_connection_channels(connection_id):
+    return await db.fetchone("SELECT source_channel, destination_channel FROM channel_connections WHERE id = ?", (connection_id,))
 
 # تابع افزودن واترمارک به تصویر
 def add_watermark(image_bytes, watermark_text):
@@ -227,104 +500,653 @@ def add_watermark(image_bytes, watermark_text):
     output.seek(0)
     return output
 
+# موتور جایگزینی کلمات: قوانین هر اتصال یک بار در یک regex مبتنی بر trie کامپایل می‌شوند
+class WordReplacer:
+    """
+    همهٔ قوانین یک اتصال را در یک عبور روی متن اعمال می‌کند (طولانی‌ترین تطابق از چپ).
+    چون الگو از trie ساخته شده، در هر موقعیت فقط شاخه‌ای که با همان حرف شروع می‌شود امتحان می‌شود
+    و هزینه به تعداد قوانین بستگی ندارد. خروجی یک قانون دوباره جایگزین نمی‌شود.
+    """
+
+    def __init__(self, rules):
+        self.mapping = {}
+        for original, replacement in rules:
+            # قانون تکراری: مثل قبل اولین قانون برنده است؛ کلمهٔ خالی نادیده گرفته می‌شود
+            if original and original not in self.mapping:
+                self.mapping[original] = replacement
+
+        self.pattern = _compile_rules(self.mapping) if self.mapping else None
+
+    def apply(self, text):
+        if text is None or self.pattern is None:
+            return text
+        return self.pattern.sub(self._substitute, text)
+
+    def _substitute(self, match):
+        return self.mapping[match.group(0)]
+
+def _compile_rules(words):
+    try:
+        return re.compile(_trie_pattern(words))
+    except RecursionError:
+        # زنجیرهٔ خیلی بلند از کلمه‌هایی که پیشوند هم هستند گروه‌های تودرتوی زیادی می‌سازد که
+        # کامپایلر re از پسش برنمی‌آید؛ جایگزین هم‌معنا: alternation ساده از بلندترین به کوتاه‌ترین
+        return re.compile("|".join(re.escape(word) for word in sorted(words, key=len, reverse=True)))
+
+def _trie_pattern(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    # الگوی هر گره بعد از الگوی فرزندانش ساخته می‌شود؛ با پشتهٔ صریح و بدون بازگشت،
+    # تا طول کلمه (مثلاً یک امضای چند هزار حرفی) محدودیتی نداشته باشد
+    patterns = {}
+    stack = [(trie, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for ch, child in node.items() if ch != "")
+            continue
+
+        branches = [re.escape(ch) + patterns.pop(id(child)) for ch, child in node.items() if ch != ""]
+        if not branches:
+            pattern = ""
+        else:
+            pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            if "" in node:
+                # این گره پایان یک کلمه هم هست؛ ادامهٔ طولانی‌تر اختیاری و greedy است
+                pattern = "(?:" + pattern + ")?"
+        patterns[id(node)] = pattern
+    return patterns[id(trie)]
+
+_word_replacers = {}
+
+def invalidate_word_replacer(connection_id):
+    _word_replacers.pop(connection_id, None)
+
+async def get_word_replacer(connection_id):
+    replacer = _word_replacers.get(connection_id)
+    if replacer is None:
+        replacer = WordReplacer(await get_word_replacements(connection_id))
+        _word_replacers[connection_id] = replacer
+    return replacer
+
 # تابع جایگزینی کلمات در متن بر اساس قوانین تعریف شده
-def replace_words(text, connection_id):
+async def replace_words(text, connection_id):
     if text is None:
         return None
         
-    replacements = get_word_replacements(connection_id)
-    for original, replacement in replacements:
-        text = text.replace(original, replacement)
-    
-    return text
+    return (await get_word_replacer(connection_id)).apply(text)
 
-def set_connection_watermark(connection_id, watermark_text):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE channel_connections SET watermark_text = ? WHERE id = ?", (watermark_text, connection_id))
-    conn.commit()
-    conn.close()
+async def set_connection_watermark(connection_id, watermark_text):
+    await db.execute("UPDATE channel_connections SET watermark_text = ? WHERE id = ?", (watermark_text, connection_id))
+    invalidate_routing_index()
+    invalidate_watermark_cache(connection_id)
 
-def get_connection_watermark(connection_id):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT watermark_text FROM channel_connections WHERE id = ?", (connection_id,))
-    result = cursor.fetchone()
-    conn.close()
+async def get_connection_watermark(connection_id):
+    result = await db.fetchone("SELECT watermark_text FROM channel_connections WHERE id = ?", (connection_id,))
     return result[0] if result else None
 
+async def set_connection_encode_profile(connection_id, profile_name):
+    await db.execute("UPDATE channel_connections SET encode_profile = ? WHERE id = ?", (profile_name, connection_id))
+    invalidate_routing_index()
+
+async def get_connection_encode_profile(connection_id):
+    result = await db.fetchone("SELECT encode_profile FROM channel_connections WHERE id = ?", (connection_id,))
+    return encode_profile_name(result[0] if result else None)
+
+# کش واترمارک تصاویر: کاشی‌های از پیش رندر و blur شده و لایه‌های کامل برای هر رزولوشن
+WATERMARK_FONT_SIZE = 70
+WATERMARK_STEP = WATERMARK_FONT_SIZE * 4  # فاصلهٔ تکرار متن روی تصویر
+WATERMARK_BLUR_RADIUS = 1.5
+WATERMARK_TILE_CACHE_SIZE = int(os.getenv("WATERMARK_TILE_CACHE_SIZE", 256))
+WATERMARK_OVERLAY_CACHE_MB = int(os.getenv("WATERMARK_OVERLAY_CACHE_MB", 64))
+
+_watermark_cache_lock = threading.Lock()
+_watermark_tiles = OrderedDict()     # (conn_id, text) -> کاشی RGBA
+_watermark_overlays = OrderedDict()  # (conn_id, text, size) -> لایهٔ کامل RGBA
+_watermark_overlays_bytes = 0
+
+@functools.lru_cache(maxsize=16)
+def load_watermark_font(size):
+    try:
+        return ImageFont.truetype("Impact.ttf", size)
+    except IOError:
+        return ImageFont.load_default()
+
+def render_watermark_tile(watermark_text):
+    """
+    یک کاشی WATERMARK_STEP×WATERMARK_STEP متناوب می‌سازد که کنار هم چیدنش دقیقاً همان الگوی
+    شبکه‌ای متن روی تصویر را می‌دهد (بخشی از متن که از خانهٔ قبلی بیرون زده هم داخلش هست).
+    blur روی یک بوم بزرگ‌تر زده و خانهٔ میانی برش داده می‌شود تا لبه‌های کاشی درز نداشته باشند.
+    """
+    font = load_watermark_font(WATERMARK_FONT_SIZE)
+    probe = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = probe.textbbox((0, 0), watermark_text, font=font)
+
+    cells_x = -(-max(right, 1) // WATERMARK_STEP) + 2
+    cells_y = -(-max(bottom, 1) // WATERMARK_STEP) + 2
+    canvas = Image.new("RGBA", (cells_x * WATERMARK_STEP, cells_y * WATERMARK_STEP), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(canvas)
+    for i in range(cells_x):
+        for j in range(cells_y):
+            draw.text((i * WATERMARK_STEP, j * WATERMARK_STEP), watermark_text, font=font, fill=(255, 255, 255, 128))
+    canvas = canvas.filter(ImageFilter.GaussianBlur(radius=WATERMARK_BLUR_RADIUS))
+
+    x0 = (cells_x - 2) * WATERMARK_STEP
+    y0 = (cells_y - 2) * WATERMARK_STEP
+    return canvas.crop((x0, y0, x0 + WATERMARK_STEP, y0 + WATERMARK_STEP))
+
+def get_watermark_overlay(connection_id, watermark_text, size):
+    """لایهٔ واترمارک هم‌اندازهٔ تصویر را از کش (LRU) برمی‌گرداند یا با چیدن کاشی می‌سازد."""
+    global _watermark_overlays_bytes
+
+    key = (connection_id, watermark_text, size)
+    with _watermark_cache_lock:
+        overlay = _watermark_overlays.get(key)
+        if overlay is not None:
+            _watermark_overlays.move_to_end(key)
+            return overlay
+
+        tile_key = (connection_id, watermark_text)
+        tile = _watermark_tiles.get(tile_key)
+        if tile is not None:
+            _watermark_tiles.move_to_end(tile_key)
+
+    if tile is None:
+        tile = render_watermark_tile(watermark_text)
+
+    width, height = size
+    overlay = Image.new("RGBA", size, (255, 255, 255, 0))
+    for x in range(0, width, WATERMARK_STEP):
+        for y in range(0, height, WATERMARK_STEP):
+            overlay.paste(tile, (x, y))
+
+    overlay_bytes = width * height * 4
+    limit = WATERMARK_OVERLAY_CACHE_MB * 1024 * 1024
+    with _watermark_cache_lock:
+        _watermark_tiles[tile_key] = tile
+        _watermark_tiles.move_to_end(tile_key)
+        while len(_watermark_tiles) > WATERMARK_TILE_CACHE_SIZE:
+            _watermark_tiles.popitem(last=False)
+
+        if overlay_bytes <= limit and key not in _watermark_overlays:
+            _watermark_overlays[key] = overlay
+            _watermark_overlays_bytes += overlay_bytes
+            while _watermark_overlays_bytes > limit:
+                (_, _, (w, h)), _ = _watermark_overlays.popitem(last=False)
+                _watermark_overlays_bytes -= w * h * 4
+
+    return overlay
+
+def invalidate_watermark_cache(connection_id):
+    global _watermark_overlays_bytes
+
+    with _watermark_cache_lock:
+        for key in [k for k in _watermark_tiles if k[0] == connection_id]:
+            del _watermark_tiles[key]
+        for key in [k for k in _watermark_overlays if k[0] == connection_id]:
+            width, height = key[2]
+            del _watermark_overlays[key]
+            _watermark_overlays_bytes -= width * height * 4
+
+def watermark_photo(image_bytes, connection_id, watermark_text):
+    """
+    واترمارک کاشی‌شده را روی عکس می‌گذارد و JPEG برمی‌گرداند.
+    کار CPU است؛ فراخواننده‌ها آن را با asyncio.to_thread اجرا می‌کنند.
+    """
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
+    if watermark_text:
+        image = Image.alpha_composite(image, get_watermark_overlay(connection_id, watermark_text, image.size))
+
+    output = io.BytesIO()
+    image.convert("RGB").save(output, format="JPEG")
+    output.seek(0)
+    return output
+
 def frame_to_bytes(frame):
     output = io.BytesIO()
     frame.save(output, format="PNG")
     output.seek(0)
     return output.getvalue()
 
-def add_text_watermark_to_video(video_bytes: bytes, watermark_text: str, is_gif: bool = False) -> bytes:
+# صف ناهمگام ffmpeg: تعداد کارگرها به اندازهٔ هسته‌های CPU، با سقف صف و timeout برای هر کار
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", os.cpu_count() or 1))
+FFMPEG_MAX_QUEUE = int(os.getenv("FFMPEG_MAX_QUEUE", 32))
+FFMPEG_JOB_TIMEOUT = int(os.getenv("FFMPEG_JOB_TIMEOUT", 600))
+
+# پروفایل‌های انکود ویدیو؛ هر اتصال یکی را انتخاب می‌کند (ستون encode_profile).
+# threads=None یعنی مقدار FFMPEG_THREADS (صفر: انتخاب خودکار ffmpeg).
+ENCODE_PROFILES = {
+    "ultrafast": {"preset": "ultrafast", "crf": 28, "max_height": 480, "threads": None, "faststart": True},
+    "fast": {"preset": "veryfast", "crf": 26, "max_height": 720, "threads": None, "faststart": True},
+    "balanced": {"preset": "faster", "crf": 23, "max_height": 1080, "threads": None, "faststart": True},
+    "quality": {"preset": "medium", "crf": 20, "max_height": None, "threads": None, "faststart": True},
+}
+DEFAULT_ENCODE_PROFILE = os.getenv("ENCODE_PROFILE", "balanced")
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", 0))
+# گیف‌های تلگرام در واقع MP4 بی‌صدا هستند؛ با libx264 و حداقل این سرعت انکود می‌شوند
+ANIMATION_PRESET = os.getenv("ANIMATION_PRESET", "veryfast")
+X264_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+
+def animation_preset(profile_preset):
+    """سریع‌ترِ preset پروفایل و ANIMATION_PRESET"""
+    candidates = [p for p in (profile_preset, ANIMATION_PRESET) if p in X264_PRESETS]
+    return min(candidates, key=X264_PRESETS.index) if candidates else "veryfast"
+VIDEO_WATERMARK_FONT = os.getenv("VIDEO_WATERMARK_FONT", "Impact.ttf")
+
+def encode_profile_name(name):
+    if name in ENCODE_PROFILES:
+        return name
+    return DEFAULT_ENCODE_PROFILE if DEFAULT_ENCODE_PROFILE in ENCODE_PROFILES else "balanced"
+
+class FFmpegPool:
+    """
+    اجرای ffmpeg به صورت subprocess ناهمگام تا انکد یک ویدیو حلقهٔ asyncio را قفل نکند.
+    حداکثر `workers` کار همزمان اجرا می‌شود و حداکثر `max_queue` کار در صف می‌ماند؛
+    بیشتر از آن، فراخواننده تا خالی شدن جا منتظر می‌ماند (backpressure) و کاری رد نمی‌شود.
+    با timeout یا لغو شدن کار، پروسهٔ ffmpeg کشته می‌شود.
+    """
+
+    def __init__(self, workers, max_queue, timeout):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(workers)
+        self._admission = asyncio.Semaphore(workers + max_queue)
+        self._pending = 0  # کارهای در حال اجرا + منتظر
+
+    @property
+    def queue_depth(self):
+        return self._pending
+
+    async def run(self, args, timeout=None, stdin_chunks=None):
+        """
+        ffmpeg را اجرا می‌کند. اگر stdin_chunks (یک async iterator از bytes) داده شود،
+        تکه‌ها همان‌طور که می‌رسند به stdin پروسه داده می‌شوند.
+        """
+        self._pending += 1
+        try:
+            async with self._admission, self._semaphore:
+                return await asyncio.wait_for(self._exec(args, stdin_chunks), timeout or self.timeout)
+        finally:
+            self._pending -= 1
+
+    async def _exec(self, args, stdin_chunks):
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE if stdin_chunks is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            if stdin_chunks is not None:
+                _, stderr, _ = await asyncio.gather(_feed_stdin(proc, stdin_chunks), proc.stderr.read(), proc.wait())
+            else:
+                _, stderr = await proc.communicate()
+        except BaseException:
+            # timeout (لغو از سمت wait_for)، لغو کار یا خطای دانلود: پروسه نباید یتیم بماند
+            _kill_process(proc)
+            await proc.wait()
+            raise
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args, None, stderr.decode(errors="replace"))
+        return stderr
+
+async def _feed_stdin(proc, chunks):
     try:
-        # اعتبارسنجی داده ورودی
-        if not video_bytes or len(video_bytes) < 100:  # حداقل اندازه برای یک فایل گیف/ویدیو
-            logger.error("⛔️ داده ورودی نامعتبر یا خالی است")
-            return video_bytes
+        async for chunk in chunks:
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg زودتر بسته شده؛ کد خروجش خطا را مشخص می‌کند
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
 
-        logger.debug(f"اندازه داده ورودی: {len(video_bytes)} بایت")
+def _kill_process(proc):
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+
+ffmpeg_pool = FFmpegPool(FFMPEG_WORKERS, FFMPEG_MAX_QUEUE, FFMPEG_JOB_TIMEOUT)
 
-        suffix = '.gif' if is_gif else '.mp4'
+def new_temp_path(suffix):
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return path
 
-        # ایجاد فایل موقت برای ورودی
-        input_path = tempfile.mktemp(suffix=suffix)
-        with open(input_path, 'wb') as input_file:
-            input_file.write(video_bytes)
-            input_file.flush()
+def remove_temp_file(path):
+    try:
+        if path and os.path.exists(path):
+            os.remove(path)
+    except Exception:
+        pass
+
+async def download_to_temp(client, media, suffix):
+    """رسانه را تکه‌تکه روی یک فایل موقت دانلود می‌کند (بدون نگه‌داشتن کل فایل در حافظه)."""
+    path = new_temp_path(suffix)
+    try:
+        with metrics.timer("download"):
+            return await client.download_media(media, file_name=path)
+    except BaseException:
+        remove_temp_file(path)
+        raise
+
+# کش محتوای دانلودشده بر اساس file_unique_id: هر رسانه فقط یک بار از تلگرام گرفته می‌شود
+# حتی اگر به چند مقصد، بک‌فیل و بررسی کانال‌های محدود برسد
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "media_cache")
+MEDIA_CACHE_MEMORY_MB = int(os.getenv("MEDIA_CACHE_MEMORY_MB", 64))
+MEDIA_CACHE_MEMORY_ITEM_MB = int(os.getenv("MEDIA_CACHE_MEMORY_ITEM_MB", 5))
+MEDIA_CACHE_DISK_MB = int(os.getenv("MEDIA_CACHE_DISK_MB", 2048))
+
+class MediaCache:
+    """
+    دو لایه با حذف LRU: فایل‌های کوچک (عکس، صوت) در حافظه و بقیه روی دیسک.
+    دانلودهای همزمان یک فایل یکی می‌شوند (single-flight). فایل‌هایی که ffmpeg در حال
+    خواندنشان است pin می‌شوند تا حذف نشوند. فایل‌های بزرگ‌تر از یک‌چهارم ظرفیت دیسک کش نمی‌شوند.
+    """
+
+    def __init__(self, directory, memory_limit, memory_item_limit, disk_limit):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.memory_item_limit = memory_item_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()  # unique_id -> bytes
+        self._memory_bytes = 0
+        self._disk = OrderedDict()    # unique_id -> (path, size)
+        self._disk_bytes = 0
+        self._pins = {}
+        self._inflight = {}
+
+    def reset(self):
+        """فایل‌های باقی‌مانده از اجرای قبلی را پاک می‌کند (فهرست کش فقط در حافظه است)."""
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            remove_temp_file(os.path.join(self.directory, name))
+
+    def accepts(self, media):
+        size = getattr(media, "file_size", None) or 0
+        return self.disk_limit > 0 and size <= self.disk_limit // 4
+
+    async def get_bytes(self, client, media):
+        key = media.file_unique_id
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            return data
+
+        if key in self._disk:
+            path, _ = self._disk[key]
+            self._disk.move_to_end(key)
+            self._pin(key)
+            try:
+                return await asyncio.to_thread(_read_file, path)
+            finally:
+                self._unpin(key)
+
+        size = getattr(media, "file_size", None) or 0
+        if size <= self.memory_item_limit or not self.accepts(media):
+            return await self._single_flight(("memory", key), lambda: self._download_to_memory(client, media))
+
+        async with self.pinned_path(client, media, "") as path:
+            return await asyncio.to_thread(_read_file, path)
+
+    @contextlib.asynccontextmanager
+    async def pinned_path(self, client, media, suffix):
+        """مسیر فایل کش‌شده روی دیسک را می‌دهد و تا پایان بلاک از حذف شدنش جلوگیری می‌کند."""
+        key = media.file_unique_id
+        # اگر کش خیلی شلوغ باشد ممکن است فایل بین پایان دانلود و pin شدن حذف شده باشد
+        while key not in self._disk:
+            await self._single_flight(("disk", key), lambda: self._download_to_disk(client, media, suffix))
+
+        path, _ = self._disk[key]
+        self._disk.move_to_end(key)
+        self._pin(key)
+        self._evict_disk()
+        try:
+            yield path
+        finally:
+            self._unpin(key)
+
+    async def _single_flight(self, key, download):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(download())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _download_to_memory(self, client, media):
+        with metrics.timer("download"):
+            data = (await client.download_media(media, in_memory=True)).getvalue()
+        key = media.file_unique_id
+        if len(data) <= self.memory_item_limit and key not in self._memory:
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.memory_limit and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+        return data
+
+    async def _download_to_disk(self, client, media, suffix):
+        os.makedirs(self.directory, exist_ok=True)
+        key = media.file_unique_id
+        path = os.path.abspath(os.path.join(self.directory, f"{key}{suffix}"))
+        with metrics.timer("download"):
+            path = await client.download_media(media, file_name=path)
+        size = os.path.getsize(path)
+        self._disk[key] = (path, size)
+        self._disk_bytes += size
+        return path
+
+    def _pin(self, key):
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def _unpin(self, key):
+        self._pins[key] -= 1
+        if self._pins[key] <= 0:
+            del self._pins[key]
+            self._evict_disk()
+
+    def _evict_disk(self):
+        for key in list(self._disk):
+            if self._disk_bytes <= self.disk_limit:
+                break
+            if key in self._pins:
+                continue
+            path, size = self._disk.pop(key)
+            self._disk_bytes -= size
+            remove_temp_file(path)
 
-        # ایجاد فایل موقت برای خروجی
-        output_path = tempfile.mktemp(suffix=suffix)
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
 
-        # مسیر فونت
-        font_path = "Impact.ttf"  # اطمینان حاصل کنید که این فونت وجود دارد
+def link_to_temp(path, suffix):
+    """یک نسخهٔ مستقل از فایل کش می‌سازد (hard link اگر ممکن باشد) تا حذف LRU روی ارسال اثر نگذارد."""
+    target = os.path.join(os.path.dirname(path), f"out-{os.urandom(8).hex()}{suffix}")
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copyfile(path, target)
+    return target
+
+media_cache = MediaCache(
+    MEDIA_CACHE_DIR,
+    MEDIA_CACHE_MEMORY_MB * 1024 * 1024,
+    MEDIA_CACHE_MEMORY_ITEM_MB * 1024 * 1024,
+    MEDIA_CACHE_DISK_MB * 1024 * 1024,
+)
+
+@contextlib.asynccontextmanager
+async def ffmpeg_input(client, media, suffix, allow_stream=True):
+    """
+    ورودی ffmpeg را آماده می‌کند: (source, stdin_chunks).
+    اولویت با فایل کش‌شده است؛ فایل‌های خیلی بزرگ اگر قابل استریم باشند مستقیم به stdin داده
+    می‌شوند و در غیر این صورت یک بار روی یک فایل موقت دانلود می‌شوند.
+    """
+    if media_cache.accepts(media):
+        async with media_cache.pinned_path(client, media, suffix) as path:
+            yield path, None
+    elif allow_stream and getattr(media, "supports_streaming", False):
+        yield "pipe:0", client.stream_media(media.file_id)
+    else:
+        path = await download_to_temp(client, media, suffix)
+        try:
+            yield path, None
+        finally:
+            remove_temp_file(path)
 
-        # فیلتر drawtext برای واترمارک
-        drawtext_filter = (
-            f"drawtext=fontfile={font_path}:text='{watermark_text}':"
-            f"fontcolor=white@0.4:fontsize=70:box=1:boxcolor=black@0.3:"
-            f"x=mod((w/6)*mod(t\,6)\,w):y=mod((h/6)*mod(t\,6)\,h)"
+async def probe_video(path):
+    """
+    یک بار ffprobe روی ورودی: {"width", "height", "has_audio"}؛ اگر ffprobe نبود یا خطا داد None.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-show_entries", "stream=codec_type,width,height", "-of", "json", path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
         )
+    except FileNotFoundError:
+        return None
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=30)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return None
+    except BaseException:
+        with contextlib.suppress(ProcessLookupError):
+            process.kill()
+        raise
+    if process.returncode != 0:
+        return None
 
-        # دستور FFmpeg
-        cmd = [
-            'ffmpeg',
-            '-y',
-            '-i', input_path,
-            '-vf', drawtext_filter,
-            '-c:v', 'gif' if is_gif else 'libx264',
-            '-c:a', 'copy' if not is_gif else 'none',
-            output_path
-        ]
-
-        # اجرای FFmpeg با گرفتن خروجی خطا
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        logger.debug(f"FFmpeg output: {result.stdout}")
-
-        # خواندن فایل خروجی
-        with open(output_path, 'rb') as f:
-            return f.read()
+    try:
+        streams = json.loads(stdout or b"{}").get("streams", [])
+    except ValueError:
+        return None
+    video = next((stream for stream in streams if stream.get("codec_type") == "video"), {})
+    return {
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "has_audio": any(stream.get("codec_type") == "audio" for stream in streams),
+    }
+
+def build_watermark_command(source, output_path, watermark_text, profile, info=None, is_gif=False):
+    """
+    دستور ffmpeg واترمارک متنی. info خروجی probe_video (یا ابعاد تلگرام) است؛
+    has_audio=None یعنی نامعلوم و صدا در صورت وجود کپی می‌شود.
+    is_gif: انیمیشن؛ خروجی MP4 بی‌صدا (yuv420p، ابعاد زوج) است، نه GIF.
+    لایهٔ متن را خود drawtext یک بار می‌سازد و روی هر فریم می‌گذارد.
+    """
+    info = info or {}
+
+    # مسیر فونت
+    font_path = VIDEO_WATERMARK_FONT  # اطمینان حاصل کنید که این فونت وجود دارد
+
+    # فیلتر drawtext برای واترمارک
+    video_filter = (
+        f"drawtext=fontfile={font_path}:text='{watermark_text}':"
+        f"fontcolor=white@0.4:fontsize=70:box=1:boxcolor=black@0.3:"
+        f"x=mod((w/6)*mod(t\,6)\,w):y=mod((h/6)*mod(t\,6)\,h)"
+    )
+    max_height = profile.get("max_height")
+    if max_height and (info.get("height") is None or info["height"] > max_height):
+        video_filter += f",scale=-2:min(ih\,{max_height})"
+    elif is_gif:
+        # GIFهای واقعی ممکن است ابعاد فرد داشته باشند که yuv420p قبول نمی‌کند
+        video_filter += ",scale=trunc(iw/2)*2:trunc(ih/2)*2"
+
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', source, '-vf', video_filter]
+    threads = profile.get("threads") or FFMPEG_THREADS
+    if threads:
+        cmd += ['-threads', str(threads)]
+    if is_gif:
+        cmd += ['-map', '0:v:0', '-c:v', 'libx264', '-preset', animation_preset(profile["preset"]),
+                '-crf', str(profile["crf"]), '-pix_fmt', 'yuv420p', '-an', '-movflags', '+faststart']
+    else:
+        cmd += ['-map', '0:v:0', '-c:v', 'libx264', '-preset', profile["preset"], '-crf', str(profile["crf"])]
+        if info.get("has_audio") is False:
+            cmd += ['-an']
+        else:
+            cmd += ['-map', '0:a?', '-c:a', 'copy']
+        if profile.get("faststart"):
+            cmd += ['-movflags', '+faststart']
+    cmd.append(output_path)
+    return cmd
+
+async def add_text_watermark_to_video(client, media, watermark_text: str, is_gif: bool = False, profile_name=None) -> str | None:
+    """
+    ویدیو/گیف را واترمارک می‌کند و مسیر یک فایل موقت خروجی را برمی‌گرداند (با خطای ffmpeg None؛ timeout بالا می‌آید).
+    ورودی از کش رسانه خوانده می‌شود (ffmpeg_input)؛ خروجی همیشه روی یک فایل موقت نوشته می‌شود
+    تا faststart ممکن باشد و حافظهٔ مصرفی به حجم فایل وابسته نباشد.
+    """
+    suffix = animation_suffix(media) if is_gif else '.mp4'
+    # خروجی انیمیشن هم MP4 است
+    output_path = new_temp_path('.mp4')
+    profile = ENCODE_PROFILES[encode_profile_name(profile_name)]
+    try:
+        async with ffmpeg_input(client, media, suffix, allow_stream=not is_gif) as (source, stdin_chunks):
+            # ورودی استریم‌شده را نمی‌شود جدا probe کرد؛ ابعاد تلگرام کافی است
+            info = await probe_video(source) if stdin_chunks is None else None
+            if info is None:
+                info = {"width": getattr(media, "width", None), "height": getattr(media, "height", None), "has_audio": None}
+            cmd = build_watermark_command(source, output_path, watermark_text, profile, info, is_gif)
+
+            # اجرای FFmpeg در صف کارگرها؛ بقیهٔ پست‌ها در این مدت منتظر نمی‌مانند
+            with metrics.timer("watermark_ffmpeg"):
+                await ffmpeg_pool.run(cmd, stdin_chunks=stdin_chunks)
+        return output_path
 
     except subprocess.CalledProcessError as e:
         logger.error(f"⛔️ خطای FFmpeg: {e.stderr}")
-        return video_bytes
+    except asyncio.TimeoutError:
+        # فایل اصلی بدون واترمارک منتشر نمی‌شود؛ ارسال همین پیام ناموفق ثبت می‌شود
+        logger.error(f"⛔️ FFmpeg بیش از {ffmpeg_pool.timeout} ثانیه طول کشید و متوقف شد")
+        remove_temp_file(output_path)
+        raise
     except FileNotFoundError as e:
         logger.error(f"⛔️ FFmpeg یا فونت یافت نشد: {e}")
-        return video_bytes
+    except asyncio.CancelledError:
+        remove_temp_file(output_path)
+        raise
     except Exception as e:
         logger.error(f"⛔️ خطا در واترمارک‌گذاری: {e}")
-        return video_bytes
-    finally:
-        # حذف فایل‌های موقت
-        for path in [input_path, output_path]:
-            try:
-                if os.path.exists(path):
-                    os.remove(path)
-            except Exception:
-                pass
+
+    # در صورت خطا خروجی ناقص حذف می‌شود؛ خروجی موفق را فراخواننده بعد از ارسال حذف می‌کند
+    remove_temp_file(output_path)
+    return None
+
+async def watermark_video_file(client, media, watermark_text: str, is_gif: bool = False, profile_name=None) -> dict:
+    """
+    فایلی که باید ارسال شود را برمی‌گرداند: {"path": خروجی واترمارک‌شده}،
+    یا اگر ffmpeg روی فایل خطا داد، خود فایل اصلی (مثل رفتار قبلی) با "fallback": True.
+    timeout خطا بالا می‌آورد و به فایل اصلی برنمی‌گردد. فراخواننده فایل را حذف می‌کند.
+    """
+    output_path = await add_text_watermark_to_video(client, media, watermark_text, is_gif=is_gif, profile_name=profile_name)
+    if output_path:
+        return {"path": output_path}
+    return {"path": await original_media_file(client, media, animation_suffix(media) if is_gif else '.mp4'), "fallback": True}
+
+def animation_suffix(media):
+    return '.gif' if getattr(media, "mime_type", None) == "image/gif" else '.mp4'
+
+async def original_media_file(client, media, suffix):
+    """یک فایل موقت مستقل از رسانهٔ اصلی (از کش اگر ممکن باشد)؛ فراخواننده آن را حذف می‌کند."""
+    if media_cache.accepts(media):
+        async with media_cache.pinned_path(client, media, suffix) as path:
+            return link_to_temp(path, suffix)
+    return await download_to_temp(client, media, suffix)
 
 def get_reply_message_id(source_reply_id: int, message_map: dict) -> int | None:
     """
@@ -333,51 +1155,1202 @@ def get_reply_message_id(source_reply_id: int, message_map: dict) -> int | None:
     """
     return message_map.get(source_reply_id)
 
-def get_reply_dest_id_if_exists(conn_id, source_reply_id):
+async def get_reply_dest_id_if_exists(conn_id, source_reply_id):
     """
     بررسی می‌کند که آیا پیام ریپلای‌شده از کانال منبع قبلاً به مقصد منتقل شده یا نه.
     """
-    return get_destination_message_id(conn_id, source_reply_id)
+    return await get_destination_message_id(conn_id, source_reply_id)
 
-def set_connection_active(connection_id: int, active: bool):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE channel_connections SET is_active = ? WHERE id = ?", (1 if active else 0, connection_id))
-    conn.commit()
-    conn.close()
+async def set_connection_active(connection_id: int, active: bool):
+    await db.execute("UPDATE channel_connections SET is_active = ? WHERE id = ?", (1 if active else 0, connection_id))
+    invalidate_routing_index()
 
-def get_connection_by_id(connection_id: int):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""SELECT id, source_channel, destination_channel, is_active, last_scanned_message_id
-                      FROM channel_connections WHERE id = ?""", (connection_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return row  # (id, source, dest, is_active, last_scanned)
+async def set_connection_restricted(connection_id: int, restricted: bool):
+    await db.execute("UPDATE channel_connections SET is_restricted = ? WHERE id = ?", (1 if restricted else 0, connection_id))
+    invalidate_routing_index()
 
-def get_active_connections():
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""SELECT id, source_channel, destination_channel
-                      FROM channel_connections WHERE is_active = 1""")
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+async def is_connection_restricted(connection_id: int) -> bool:
+    row = await db.fetchone("SELECT is_restricted FROM channel_connections WHERE id = ?", (connection_id,))
+    return bool(row and row[0])
 
-def get_last_scanned_message_id(connection_id: int) -> int:
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_scanned_message_id FROM channel_connections WHERE id = ?", (connection_id,))
-    row = cursor.fetchone()
-    conn.close()
+async def get_connection_by_id(connection_id: int):
+    return await db.fetchone("""SELECT id, source_channel, destination_channel, is_active, last_scanned_message_id
+                                FROM channel_connections WHERE id = ?""", (connection_id,))  # (id, source, dest, is_active, last_scanned)
+
+async def get_active_connections():
+    return await db.fetchall("""SELECT id, source_channel, destination_channel, watermark_text, is_restricted, encode_profile
+                                FROM channel_connections WHERE is_active = 1""")
+
+async def get_restricted_connections():
+    return await db.fetchall("SELECT id, source_channel, destination_channel FROM channel_connections WHERE is_restricted = 1")
+
+async def get_last_scanned_message_id(connection_id: int) -> int:
+    row = await db.fetchone("SELECT last_scanned_message_id FROM channel_connections WHERE id = ?", (connection_id,))
     return int(row[0]) if row and row[0] else 0
 
-def update_last_scanned_message_id(connection_id: int, msg_id: int):
-    conn = sqlite3.connect('transfer_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE channel_connections SET last_scanned_message_id = ? WHERE id = ?", (int(msg_id), connection_id))
-    conn.commit()
-    conn.close()
+async def update_last_scanned_message_id(connection_id: int, msg_id: int):
+    await db.execute("UPDATE channel_connections SET last_scanned_message_id = ? WHERE id = ?", (int(msg_id), connection_id))
+
+# کارهای بک‌فیل
+BACKFILL_JOB_FIELDS = ("id", "connection_id", "status", "cursor_message_id", "target_message_id", "scanned_count",
+                       "transferred_count", "failed_count", "rate", "error", "created_at", "updated_at", "finished_at")
+
+def _backfill_job_row(row):
+    return dict(zip(BACKFILL_JOB_FIELDS, row)) if row else None
+
+async def create_backfill_job(connection_id: int) -> int:
+    return await db.execute("INSERT INTO backfill_jobs (connection_id) VALUES (?)", (connection_id,))
+
+async def get_backfill_job(job_id: int):
+    row = await db.fetchone(f"SELECT {', '.join(BACKFILL_JOB_FIELDS)} FROM backfill_jobs WHERE id = ?", (job_id,))
+    return _backfill_job_row(row)
+
+async def get_open_backfill_job(connection_id: int):
+    """کار در حال اجرا یا متوقف‌شدهٔ یک اتصال (در هر لحظه حداکثر یکی)"""
+    row = await db.fetchone(f"SELECT {', '.join(BACKFILL_JOB_FIELDS)} FROM backfill_jobs "
+                            f"WHERE connection_id = ? AND status IN ('running', 'paused') ORDER BY id DESC LIMIT 1",
+                            (connection_id,))
+    return _backfill_job_row(row)
+
+async def get_backfill_jobs(limit=10, status=None):
+    if status:
+        rows = await db.fetchall(f"SELECT {', '.join(BACKFILL_JOB_FIELDS)} FROM backfill_jobs WHERE status = ? ORDER BY id DESC LIMIT ?",
+                                 (status, limit))
+    else:
+        rows = await db.fetchall(f"SELECT {', '.join(BACKFILL_JOB_FIELDS)} FROM backfill_jobs ORDER BY id DESC LIMIT ?", (limit,))
+    return [_backfill_job_row(row) for row in rows]
+
+async def set_backfill_job_status(job_id: int, status: str, error=None):
+    finished = status in ("done", "failed", "cancelled")
+    await db.execute(f"UPDATE backfill_jobs SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP"
+                     f"{', finished_at = CURRENT_TIMESTAMP' if finished else ''} WHERE id = ?",
+                     (status, error, job_id))
+
+async def set_backfill_job_target(job_id: int, target_message_id: int):
+    await db.execute("UPDATE backfill_jobs SET target_message_id = ? WHERE id = ?", (int(target_message_id), job_id))
+
+# زمان‌بند ارسال: همهٔ send_* و get_chat هر دو کلاینت از سطل‌های توکن (سراسری و هر چت) رد می‌شوند.
+# FloodWait فقط سطل همان چت را متوقف می‌کند و درخواست خودکار دوباره امتحان می‌شود.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 25))  # درخواست در ثانیه برای هر کلاینت
+SEND_GLOBAL_BURST = int(os.getenv("SEND_GLOBAL_BURST", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))  # پیام در ثانیه برای هر چت
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 5))
+
+PRIORITY_REALTIME = 0
+PRIORITY_BACKFILL = 1
+# اولویت درخواست‌های task فعلی؛ بک‌فیل آن را PRIORITY_BACKFILL می‌کند
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_REALTIME)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """چند ثانیه تا آزاد شدن یک توکن مانده است"""
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class SendScheduler:
+    """
+    call(client, chat, factory): factory یک coroutine جدید می‌سازد (برای هر تلاش از نو، تا BytesIO مصرف‌شده
+    دوباره فرستاده نشود). درخواست‌های بک‌فیل تا وقتی درخواست لحظه‌ای منتظر است کنار می‌کشند.
+    """
+
+    def __init__(self):
+        self._global = {}  # client.name -> TokenBucket
+        self._chats = {}   # (client.name, chat) -> TokenBucket
+        self._realtime_waiting = 0
+        self._realtime_idle = asyncio.Event()
+        self._realtime_idle.set()
+        self._listeners = []
+        self.last_flood_wait = None  # (chat, seconds, time.time())
+
+    def add_listener(self, callback):
+        """callback(chat, seconds) با هر FloodWait صدا زده می‌شود"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with contextlib.suppress(ValueError):
+            self._listeners.remove(callback)
+
+    def _buckets(self, client, chat):
+        global_bucket = self._global.get(client.name)
+        if global_bucket is None:
+            global_bucket = self._global[client.name] = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_BURST)
+        chat_bucket = self._chats.get((client.name, chat))
+        if chat_bucket is None:
+            chat_bucket = self._chats[(client.name, chat)] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        return global_bucket, chat_bucket
+
+    async def _acquire(self, client, chat, priority):
+        global_bucket, chat_bucket = self._buckets(client, chat)
+        realtime = priority == PRIORITY_REALTIME
+        if realtime:
+            self._realtime_waiting += 1
+            self._realtime_idle.clear()
+        try:
+            while True:
+                if not realtime and not self._realtime_idle.is_set():
+                    await self._realtime_idle.wait()
+                    continue
+                now = time.monotonic()
+                wait = max(global_bucket.delay(now), chat_bucket.delay(now))
+                if wait <= 0:
+                    global_bucket.take()
+                    chat_bucket.take()
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            if realtime:
+                self._realtime_waiting -= 1
+                if self._realtime_waiting == 0:
+                    self._realtime_idle.set()
+
+    async def call(self, client, chat, factory):
+        priority = send_priority.get()
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            with span("rate_limit"):
+                await self._acquire(client, chat, priority)
+            try:
+                return await factory()
+            except FloodWait as fw:
+                seconds = int(fw.value) + 1
+                self._buckets(client, chat)[1].block(seconds)
+                self.last_flood_wait = (chat, seconds, time.time())
+                for callback in list(self._listeners):
+                    callback(chat, seconds)
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                logger.warning(f"⏳ FloodWait {seconds}s برای {chat}؛ تلاش دوباره ({attempt + 1}/{SEND_MAX_RETRIES})")
+
+send_scheduler = SendScheduler()
+
+# ردیابی پست‌های کند: هر انتقال یک trace دارد و هر مرحله (span) با زمان monotonic در آن ثبت می‌شود.
+# traceهایی که از SLOW_POST_SECONDS طولانی‌تر شوند در یک ring buffer می‌مانند (دستور /slow).
+# با SLOW_POST_SECONDS=0 هیچ traceی ساخته نمی‌شود و هر span فقط یک ContextVar.get است.
+SLOW_POST_SECONDS = float(os.getenv("SLOW_POST_SECONDS", 30))
+SLOW_POST_BUFFER = int(os.getenv("SLOW_POST_BUFFER", 50))
+TRACE_MAX_SPANS = 200
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+slow_posts = deque(maxlen=SLOW_POST_BUFFER)
+
+class PostTrace:
+    __slots__ = ("label", "started", "delay", "spans", "token", "detached_at")
+
+    def __init__(self, label, posted_at=None):
+        self.label = label
+        self.started = time.monotonic()
+        # فاصلهٔ انتشار در منبع تا شروع پردازش (پنجرهٔ آلبوم، صف مقصد)
+        self.delay = max(0.0, time.time() - posted_at.timestamp()) if posted_at else 0.0
+        self.spans = []  # (name, offset, duration)
+        self.token = None
+        self.detached_at = None
+
+    def add(self, name, started, duration):
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((name, started - self.started, duration))
+
+def start_trace(label, posted_at=None):
+    if SLOW_POST_SECONDS <= 0:
+        return None
+    trace = PostTrace(label, posted_at)
+    trace.token = current_trace.set(trace)
+    return trace
+
+def detach_trace(trace):
+    """trace را از task فعلی جدا می‌کند تا task دیگری (مثلاً ترتیب‌دهندهٔ بک‌فیل) ادامه‌اش دهد."""
+    if trace is not None:
+        current_trace.reset(trace.token)
+        trace.token = None
+        trace.detached_at = time.monotonic()
+
+def attach_trace(trace):
+    if trace is not None:
+        trace.token = current_trace.set(trace)
+        # فاصلهٔ جدا شدن تا ادامه (انتظار برای نوبت ترتیب)
+        trace.add("ordering_wait", trace.detached_at, time.monotonic() - trace.detached_at)
+
+def finish_trace(trace, error=None):
+    if trace is None:
+        return
+    if trace.token is not None:
+        current_trace.reset(trace.token)
+    total = time.monotonic() - trace.started
+    if trace.delay + total >= SLOW_POST_SECONDS:
+        slow_posts.append({
+            "at": time.time(),
+            "label": trace.label,
+            "delay": trace.delay,
+            "total": total,
+            "spans": trace.spans,
+            "error": str(error) if error else None,
+        })
+
+@contextlib.contextmanager
+def span(name):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(name, started, time.monotonic() - started)
+
+def summarize_spans(spans):
+    """مجموع زمان هر مرحله، از کندترین: [(name, count, seconds)]"""
+    totals = {}
+    for name, _, duration in spans:
+        count, seconds = totals.get(name, (0, 0.0))
+        totals[name] = (count + 1, seconds + duration)
+    return sorted(((name, count, seconds) for name, (count, seconds) in totals.items()), key=lambda item: -item[2])
+
+# متریک‌های درون‌برنامه‌ای: مسیرهای انتقال شمارنده‌ها را همان لحظه به‌روز می‌کنند
+# و داشبورد وضعیت فقط از همین snapshot (بدون کوئری دیتابیس) ساخته می‌شود
+METRICS_THROUGHPUT_WINDOW = 300  # ثانیه
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# برچسب‌های پیش‌فرض مشاهده‌ها: (conn_id, media kind) پیامی که task فعلی روی آن کار می‌کند
+metric_labels = contextvars.ContextVar("metric_labels", default=(None, None))
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.connections = {}  # conn_id -> شمارنده‌ها
+        self.latency = {}      # media kind -> [count, total_seconds]
+        self.last_flood_wait = None  # (chat, seconds, time.time())
+        self._recent = deque()  # زمان انتقال‌های اخیر برای محاسبهٔ throughput
+        self._gauges = {}
+        self.histograms = {}   # (stage, kind, conn_id) -> [bucket counts, sum, count]
+        self.flood_wait_seconds = {}  # conn_id -> ثانیه
+        self.dropped = {}      # (kind, conn_id) -> تعداد
+
+    def observe(self, stage, seconds, kind=None, conn_id=None):
+        """یک زمان‌سنجی مرحله (download، watermark_pil، watermark_ffmpeg، upload، copy، db)"""
+        default_conn, default_kind = metric_labels.get()
+        key = (stage, kind or default_kind or "other", conn_id if conn_id is not None else default_conn)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(METRICS_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage, kind=None):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            self.observe(stage, duration, kind)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add(stage, started, duration)
+
+    def timed(self, stage, factory, kind=None):
+        """factory یک coroutine می‌سازد؛ هر بار اجرا (هر تلاش مجدد) جدا اندازه گرفته می‌شود."""
+        async def run():
+            with self.timer(stage, kind):
+                return await factory()
+        return run
+
+    def _connection(self, conn_id):
+        stats = self.connections.get(conn_id)
+        if stats is None:
+            stats = self.connections[conn_id] = {
+                "transfers": 0, "failures": 0, "bytes_in": 0, "bytes_out": 0, "last_transfer": None,
+            }
+        return stats
+
+    def gauge(self, name, probe):
+        """probe() هنگام snapshot صدا زده می‌شود (مثلاً طول صف‌ها)"""
+        self._gauges[name] = probe
+
+    def record_transfer(self, conn_id, kind, seconds, bytes_in=0, bytes_out=0, count=1):
+        now = time.time()
+        stats = self._connection(conn_id)
+        stats["transfers"] += count
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += bytes_out
+        stats["last_transfer"] = now
+        latency = self.latency.setdefault(kind or "other", [0, 0.0])
+        latency[0] += count
+        latency[1] += seconds
+        self._recent.extend([now] * count)
+        self._trim(now)
+
+    def record_failure(self, conn_id, kind=None):
+        self._connection(conn_id)["failures"] += 1
+        key = (kind or "other", conn_id)
+        self.dropped[key] = self.dropped.get(key, 0) + 1
+
+    def record_flood_wait(self, chat, seconds):
+        self.last_flood_wait = (chat, seconds, time.time())
+        conn_id, _ = metric_labels.get()
+        self.flood_wait_seconds[conn_id] = self.flood_wait_seconds.get(conn_id, 0) + seconds
+
+    def _trim(self, now):
+        while self._recent and self._recent[0] < now - METRICS_THROUGHPUT_WINDOW:
+            self._recent.popleft()
+
+    def throughput(self, seconds=60):
+        """انتقال در دقیقه در `seconds` ثانیهٔ اخیر"""
+        now = time.time()
+        self._trim(now)
+        recent = sum(1 for stamp in self._recent if stamp >= now - seconds)
+        return recent * 60 / seconds
+
+    def snapshot(self):
+        gauges = {}
+        for name, probe in self._gauges.items():
+            try:
+                gauges[name] = probe()
+            except Exception:
+                gauges[name] = None
+        return {
+            "uptime": time.time() - self.started_at,
+            "connections": {conn_id: dict(stats) for conn_id, stats in self.connections.items()},
+            "latency": {kind: (count, total / count if count else 0.0) for kind, (count, total) in self.latency.items()},
+            "throughput_1m": self.throughput(60),
+            "throughput_5m": self.throughput(METRICS_THROUGHPUT_WINDOW),
+            "last_flood_wait": self.last_flood_wait,
+            "gauges": gauges,
+        }
+
+    def render(self, openmetrics=False):
+        """متن قابل scrape برای Prometheus (text 0.0.4) یا OpenMetrics"""
+        lines = []
+
+        def labels(**values):
+            pairs = [f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for name, value in values.items() if value is not None]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        def family(name, kind, help_text):
+            # در OpenMetrics نام خانوادهٔ counter بدون پسوند _total است
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        family("channelbot_stage_seconds", "histogram", "Time spent per pipeline stage")
+        for (stage, kind, conn_id), (buckets, total, count) in sorted(self.histograms.items(), key=str):
+            for bound, bucket_count in zip(METRICS_BUCKETS, buckets):
+                lines.append(f"channelbot_stage_seconds_bucket{labels(stage=stage, media_type=kind, connection=conn_id, le=bound)} {bucket_count}")
+            lines.append(f"channelbot_stage_seconds_bucket{labels(stage=stage, media_type=kind, connection=conn_id, le='+Inf')} {count}")
+            lines.append(f"channelbot_stage_seconds_sum{labels(stage=stage, media_type=kind, connection=conn_id)} {total}")
+            lines.append(f"channelbot_stage_seconds_count{labels(stage=stage, media_type=kind, connection=conn_id)} {count}")
+
+        counter = "channelbot_transfers" if openmetrics else "channelbot_transfers_total"
+        family(counter, "counter", "Messages delivered")
+        for conn_id, stats in sorted(self.connections.items(), key=str):
+            lines.append(f"channelbot_transfers_total{labels(connection=conn_id)} {stats['transfers']}")
+
+        counter = "channelbot_dropped_messages" if openmetrics else "channelbot_dropped_messages_total"
+        family(counter, "counter", "Messages that failed and were not delivered")
+        for (kind, conn_id), count in sorted(self.dropped.items(), key=str):
+            lines.append(f"channelbot_dropped_messages_total{labels(media_type=kind, connection=conn_id)} {count}")
+
+        counter = "channelbot_flood_wait_seconds" if openmetrics else "channelbot_flood_wait_seconds_total"
+        family(counter, "counter", "Seconds Telegram asked us to wait (FloodWait)")
+        for conn_id, seconds in sorted(self.flood_wait_seconds.items(), key=str):
+            lines.append(f"channelbot_flood_wait_seconds_total{labels(connection=conn_id)} {seconds}")
+
+        family("channelbot_queue_depth", "gauge", "Items waiting in internal queues")
+        for name, value in self.snapshot()["gauges"].items():
+            # probe می‌تواند یک عدد یا dict از conn_id -> عدد برگرداند
+            for conn_id, depth in (value.items() if isinstance(value, dict) else [(None, value)]):
+                if depth is not None:
+                    lines.append(f"channelbot_queue_depth{labels(queue=name, connection=conn_id)} {depth}")
+
+        family("channelbot_uptime_seconds", "gauge", "Seconds since start")
+        lines.append(f"channelbot_uptime_seconds {time.time() - self.started_at}")
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+send_scheduler.add_listener(metrics.record_flood_wait)
+metrics.gauge("delivery_queue", lambda: delivery_engine.queue_depth())
+metrics.gauge("ffmpeg_queue", lambda: ffmpeg_pool.queue_depth)
+metrics.gauge("album_pending", lambda: sum(len(items) for items in album_buffer._pending.values()))
+metrics.gauge("backfill_jobs", lambda: len(backfill_tasks))
+metrics.gauge("backfill", lambda: {conn_id: probe() for conn_id, probe in backfill_backlog.items()})
+metrics.gauge("restricted_waiting", lambda: restricted_poll_state["waiting"])
+metrics.gauge("restricted_polling", lambda: restricted_poll_state["polling"])
+
+# اکسپورتر HTTP (فقط کتابخانهٔ استاندارد)؛ با METRICS_PORT فعال می‌شود
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+async def _serve_metrics(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+        request_line, *headers = request.decode("latin-1").split("\r\n")
+        method, path, *_ = request_line.split(" ")
+        accept = next((h.split(":", 1)[1] for h in headers if h.lower().startswith("accept:")), "")
+        if method == "GET" and path.split("?")[0] == "/metrics":
+            openmetrics = "application/openmetrics-text" in accept
+            body = metrics.render(openmetrics).encode()
+            content_type = ("application/openmetrics-text; version=1.0.0; charset=utf-8" if openmetrics
+                            else "text/plain; version=0.0.4; charset=utf-8")
+            status = "200 OK"
+        else:
+            body, content_type, status = b"not found\n", "text/plain", "404 Not Found"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    server = await asyncio.start_server(_serve_metrics, host, port)
+    logger.info(f"📈 متریک‌ها روی http://{host}:{port}/metrics")
+    return server
+
+def media_size(msg):
+    kind = media_kind(msg)
+    if kind in (None, "text"):
+        return len(msg.text.encode()) if kind == "text" else 0
+    return getattr(getattr(msg, kind), "file_size", 0) or 0
+
+def output_size(media):
+    """حجم آپلودشده؛ file_id ذخیره‌شده و کپی سمت سرور صفر حساب می‌شوند"""
+    if not media or media.get("file_id"):
+        return 0
+    if media.get("path"):
+        with contextlib.suppress(OSError):
+            return os.path.getsize(media["path"])
+        return 0
+    return len(media.get("data") or b"")
+
+async def scheduled_get_chat(client, chat):
+    # سطل جدا برای هر کانال: resolveهای کانال‌های مختلف پشت سقف یک چت صف نمی‌کشند و فقط سقف کلی را می‌گیرند
+    return await send_scheduler.call(client, ("get_chat", str(chat).lower()), lambda: client.get_chat(chat))
+
+# کش resolve کانال‌ها: رشتهٔ تنظیم‌شده در اتصال -> CachedPeer، در حافظه و جدول peer_cache.
+# خطاهای «کانال وجود ندارد/دسترسی نیست» هم برای مدت کوتاه‌تری کش می‌شوند.
+PEER_CACHE_TTL = int(os.getenv("PEER_CACHE_TTL", 86400))
+PEER_CACHE_NEGATIVE_TTL = int(os.getenv("PEER_CACHE_NEGATIVE_TTL", 600))
+
+CachedPeer = namedtuple("CachedPeer", "id username title access_hash")
+
+class PeerNotResolved(Exception):
+    pass
+
+peer_cache = {}  # ref -> (CachedPeer | None, resolved_at, error)
+
+def _peer_ref(ref):
+    return str(ref).strip().lower()
+
+async def _load_peer_entry(key):
+    row = await db.fetchone("SELECT chat_id, username, title, access_hash, resolved_at, error FROM peer_cache WHERE ref = ?", (key,))
+    if not row:
+        return None
+    chat_id, username, title, access_hash, resolved_at, error = row
+    peer = CachedPeer(chat_id, username, title, access_hash) if chat_id is not None else None
+    return peer, resolved_at, error
+
+async def _save_peer_entry(key, peer, resolved_at, error):
+    peer_cache[key] = (peer, resolved_at, error)
+    peer = peer or CachedPeer(None, None, None, None)
+    await db.execute("INSERT OR REPLACE INTO peer_cache (ref, chat_id, username, title, access_hash, resolved_at, error) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (key, peer.id, peer.username, peer.title, peer.access_hash, resolved_at, error))
+
+async def resolve_chat(client, ref, refresh=False) -> CachedPeer:
+    """
+    جایگزین get_chat برای کانال‌های اتصال‌ها. refresh=True کش را دور می‌زند (مثلاً برای اعتبارسنجی /add).
+    اگر TTL گذشته باشد و resolve دوباره به خطای موقت (مثلاً شبکه) بخورد، مقدار قبلی برگردانده می‌شود.
+    """
+    key = _peer_ref(ref)
+    entry = peer_cache.get(key)
+    if entry is None:
+        entry = await _load_peer_entry(key)
+        if entry is not None:
+            peer_cache[key] = entry
+
+    if entry is not None and not refresh:
+        peer, resolved_at, error = entry
+        ttl = PEER_CACHE_NEGATIVE_TTL if error else PEER_CACHE_TTL
+        if time.time() - resolved_at < ttl:
+            if error:
+                raise PeerNotResolved(error)
+            return peer
+
+    try:
+        chat = await scheduled_get_chat(client, ref)
+    except (BadRequest, KeyError, ValueError) as e:
+        await _save_peer_entry(key, None, time.time(), str(e) or e.__class__.__name__)
+        raise
+    except Exception:
+        if entry is not None and entry[0] is not None:
+            logger.warning(f"⚠️ resolve دوباره {ref} ناموفق بود؛ از مقدار کش‌شده استفاده می‌شود")
+            return entry[0]
+        raise
+
+    access_hash = None
+    with contextlib.suppress(Exception):
+        # بعد از get_chat، peer در storage خود Pyrogram هست و این فراخوانی به شبکه نمی‌رود
+        access_hash = getattr(await client.resolve_peer(chat.id), "access_hash", None)
+
+    peer = CachedPeer(chat.id, getattr(chat, "username", None), getattr(chat, "title", None), access_hash)
+    await _save_peer_entry(key, peer, time.time(), None)
+    return peer
+
+async def invalidate_peer(*refs):
+    for ref in refs:
+        key = _peer_ref(ref)
+        peer_cache.pop(key, None)
+        await db.execute("DELETE FROM peer_cache WHERE ref = ?", (key,))
+
+# ایندکس مسیریابی پیام‌ها: chat.id کانال منبع -> لیست مسیرهای فعال آن
+# با هر تغییر اتصال/واترمارک باطل می‌شود و در اولین پیام بعدی دوباره ساخته می‌شود
+ROUTING_RETRY_SECONDS = 300
+
+routing_index = {}
+# منابع محدود در routing_index نیستند و فقط پایشگر آنها را منتقل می‌کند (تا پیام دوبار ارسال نشود)؛
+# پیام لحظه‌ای این منابع فقط worker پایش را بیدار می‌کند. chat.id منبع -> [conn_id]
+restricted_sources = {}
+routing_index_dirty = True
+routing_index_retry_at = None
+routing_index_lock = asyncio.Lock()
+
+def invalidate_routing_index():
+    global routing_index_dirty
+    routing_index_dirty = True
+
+async def rebuild_routing_index(client):
+    """
+    همهٔ اتصال‌های فعال را یک بار resolve می‌کند و جدول مسیریابی را می‌سازد.
+    اتصال‌هایی که resolve نشوند کنار گذاشته می‌شوند و بعد از ROUTING_RETRY_SECONDS دوباره امتحان می‌شوند.
+    """
+    global routing_index, restricted_sources, routing_index_dirty, routing_index_retry_at
+
+    async with routing_index_lock:
+        if not routing_index_dirty and not _routing_retry_due():
+            return routing_index
+
+        # قبل از awaitها پاک می‌شود تا تغییرات همزمان، ساخت مجدد بعدی را فعال کنند
+        routing_index_dirty = False
+        routing_index_retry_at = None
+
+        index = {}
+        restricted = {}
+        for conn_id, source_channel, destination_channel, watermark, is_restricted, profile in await get_active_connections():
+            if is_restricted:
+                try:
+                    source_chat = await resolve_chat(client, source_channel)
+                except Exception as e:
+                    logger.error(f"⛔️ resolve منبع محدود {source_channel} ناموفق بود: {e}")
+                    routing_index_retry_at = time.monotonic() + ROUTING_RETRY_SECONDS
+                    continue
+                restricted.setdefault(source_chat.id, []).append(conn_id)
+                continue
+
+            try:
+                source_chat = await resolve_chat(client, source_channel)
+                dest_chat = await resolve_chat(client, destination_channel)
+            except Exception as e:
+                logger.error(f"⛔️ resolve اتصال {source_channel} → {destination_channel} ناموفق بود: {e}")
+                routing_index_retry_at = time.monotonic() + ROUTING_RETRY_SECONDS
+                continue
+
+            dest_username = getattr(dest_chat, "username", None)
+            index.setdefault(source_chat.id, []).append({
+                "conn_id": conn_id,
+                "source_channel": source_channel,
+                "destination_channel": destination_channel,
+                "dest_chat_id": dest_chat.id,
+                "dest_username": dest_username,
+                "watermark_text": default_watermark_text(watermark, dest_username),
+                "is_restricted": bool(is_restricted),
+                "encode_profile": encode_profile_name(profile),
+            })
+
+        routing_index = index
+        restricted_sources = restricted
+        logger.info(f"ایندکس مسیریابی ساخته شد: {sum(len(r) for r in index.values())} مسیر از {len(index)} منبع")
+        return routing_index
+
+def _routing_retry_due():
+    return routing_index_retry_at is not None and time.monotonic() >= routing_index_retry_at
+
+async def get_routes(client, source_chat_id):
+    if routing_index_dirty or _routing_retry_due():
+        await rebuild_routing_index(client)
+    return routing_index.get(source_chat_id, [])
+
+# پردازش و ارسال پست‌ها: آماده‌سازی رسانه (دانلود + واترمارک) از ارسال جدا است
+# تا خروجی یک بار ساخته شود و بین چند مقصد یا مراحل مختلف استفاده شود
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", 8))
+
+def default_watermark_text(watermark, dest_username):
+    return watermark or (f"@{dest_username}" if dest_username else "")
+
+def media_kind(msg):
+    for kind in ("photo", "animation", "video", "sticker", "voice"):
+        if getattr(msg, kind, None):
+            return kind
+    return "text" if msg.text else None
+
+# با هر تغییر در شکل خروجی واترمارک افزایش پیدا کند تا file_idهای قدیمی دوباره استفاده نشوند
+MEDIA_PIPELINE_VERSION = 1
+
+def watermark_hash(watermark_text, encode_profile=None):
+    key = f"{MEDIA_PIPELINE_VERSION}:{watermark_text}"
+    if encode_profile:
+        # خروجی ویدیو به پروفایل انکود هم بستگی دارد
+        key += f"\0{encode_profile}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def upload_reuse_key(msg, watermark_text, encode_profile=None):
+    """کلید جدول uploaded_media برای رسانه‌هایی که پردازش می‌شوند؛ برای بقیه None."""
+    kind = media_kind(msg)
+    if kind not in ("photo", "animation", "video"):
+        return None
+    profile = encode_profile if kind in ("animation", "video") else None
+    return (getattr(msg, kind).file_unique_id, watermark_hash(watermark_text, profile), kind)
+
+async def prepare_media(client, msg, connection_id, watermark_text, reuse=True):
+    """
+    رسانهٔ پیام را دانلود و پردازش می‌کند. خروجی یک dict با "data" (bytes)، "path" (فایل موقت)
+    یا "file_id" (خروجی‌ای که قبلاً با همین واترمارک آپلود شده) است و برای متن/استیکر None.
+    بعد از ارسال باید با release_media آزاد شود.
+    """
+    profile_name = await get_connection_encode_profile(connection_id) if (msg.animation or msg.video) else None
+    reuse_key = upload_reuse_key(msg, watermark_text, profile_name)
+    if reuse_key is not None:
+        if reuse:
+            file_id = await get_uploaded_file_id(*reuse_key)
+            if file_id:
+                return {"file_id": file_id, "reuse_key": reuse_key}
+        media = await _process_media(client, msg, connection_id, watermark_text, profile_name)
+        media["reuse_key"] = reuse_key
+        return media
+    return await _process_media(client, msg, connection_id, watermark_text, profile_name)
+
+async def _process_media(client, msg, connection_id, watermark_text, profile_name=None):
+    if msg.photo:
+        photo_bytes = await media_cache.get_bytes(client, msg.photo)
+        with metrics.timer("watermark_pil"):
+            output = await asyncio.to_thread(watermark_photo, photo_bytes, connection_id, watermark_text)
+        return {"data": output.getvalue()}
+    if msg.animation:
+        return await watermark_video_file(client, msg.animation, watermark_text, is_gif=True, profile_name=profile_name)
+    if msg.video:
+        return await watermark_video_file(client, msg.video, watermark_text, profile_name=profile_name)
+    if msg.voice:
+        return {"data": await media_cache.get_bytes(client, msg.voice)}
+    return None
+
+def release_media(media):
+    if media and media.get("path"):
+        remove_temp_file(media["path"])
+
+def _upload_source(media, name):
+    if media.get("file_id"):
+        return media["file_id"]
+    if media.get("path"):
+        return media["path"]
+    # هر ارسال BytesIO خودش را می‌گیرد تا چند مقصد بتوانند همزمان از یک خروجی بخوانند
+    upload = io.BytesIO(media["data"])
+    upload.name = name
+    return upload
+
+async def remember_upload(media, sent):
+    # خروجی fallback (واترمارک ناموفق) ذخیره نمی‌شود تا دفعهٔ بعد دوباره امتحان شود
+    if sent and media and media.get("reuse_key") and not media.get("file_id") and not media.get("fallback"):
+        _, _, kind = media["reuse_key"]
+        uploaded = getattr(sent, kind, None)
+        if uploaded:
+            await save_uploaded_file_id(*media["reuse_key"], uploaded.file_id)
+
+async def send_prepared(client, msg, chat_id, media, caption, text, reply_to_message_id):
+    sent = await _send_prepared(client, msg, chat_id, media, caption, text, reply_to_message_id)
+    await remember_upload(media, sent)
+    return sent
+
+async def send_with_reuse_fallback(client, msg, chat_id, media, caption, text, reply_to_message_id, connection_id, watermark_text):
+    """
+    مثل send_prepared؛ اگر ارسال با file_id ذخیره‌شده رد شود (مثلاً file reference منقضی شده)،
+    آن ردیف پاک و رسانه از نو پردازش و آپلود می‌شود.
+    """
+    try:
+        return await send_prepared(client, msg, chat_id, media, caption, text, reply_to_message_id)
+    except BadRequest as e:
+        if not (media and media.get("file_id")):
+            raise
+        logger.warning(f"⚠️ file_id ذخیره‌شده قابل استفاده نبود، پردازش دوباره: {e}")
+        await delete_uploaded_file_id(*media["reuse_key"])
+
+    fresh = await prepare_media(client, msg, connection_id, watermark_text, reuse=False)
+    try:
+        return await send_prepared(client, msg, chat_id, fresh, caption, text, reply_to_message_id)
+    finally:
+        release_media(fresh)
+
+async def _send_prepared(client, msg, chat_id, media, caption, text, reply_to_message_id):
+    if msg.photo:
+        factory = lambda: client.send_photo(chat_id=chat_id, photo=_upload_source(media, "photo.jpg"), caption=caption,
+                                            reply_to_message_id=reply_to_message_id)
+    elif msg.animation:
+        factory = lambda: client.send_animation(chat_id=chat_id, animation=_upload_source(media, "animation.mp4"), caption=caption or "",
+                                                parse_mode=ParseMode.HTML, reply_to_message_id=reply_to_message_id)
+    elif msg.video:
+        factory = lambda: client.send_video(chat_id=chat_id, video=_upload_source(media, "video.mp4"), caption=caption,
+                                            reply_to_message_id=reply_to_message_id)
+    elif msg.sticker:
+        factory = lambda: client.send_sticker(chat_id=chat_id, sticker=msg.sticker.file_id, reply_to_message_id=reply_to_message_id)
+    elif text:
+        factory = lambda: client.send_message(chat_id=chat_id, text=text, reply_to_message_id=reply_to_message_id)
+    elif msg.voice:
+        factory = lambda: client.send_voice(chat_id=chat_id, voice=_upload_source(media, "voice.ogg"), caption=caption,
+                                            reply_to_message_id=reply_to_message_id)
+    else:
+        return None
+    return await send_scheduler.call(client, chat_id, metrics.timed("upload", factory, media_kind(msg)))
+
+# برنامهٔ تبدیل هر اتصال: اگر نه واترمارکی لازم است (متن خالی و مقصد بدون username)، نه قانون جایگزینی
+# وجود دارد و منبع هم محدود نیست، پیام سمت سرور کپی می‌شود و هیچ دانلود/آپلودی انجام نمی‌شود
+async def get_transform_plan(connection_id, watermark_text, is_restricted):
+    replacer = await get_word_replacer(connection_id)
+    plan = {"watermark": bool(watermark_text), "replace_words": replacer.pattern is not None}
+    plan["copy"] = not (plan["watermark"] or plan["replace_words"] or is_restricted)
+    return plan
+
+async def copy_to_destination(client, msg, chat_id, reply_to_message_id):
+    # فقط همان نوع‌هایی که مسیر عادی منتقل می‌کند
+    if media_kind(msg) is None:
+        return None
+    return await send_scheduler.call(client, chat_id, metrics.timed("copy", lambda: client.copy_message(
+        chat_id, msg.chat.id, msg.id, reply_to_message_id=reply_to_message_id)))
+
+async def transfer_message(client, msg, connection_id, dest_chat_id, watermark_text, reply_to_message_id):
+    """آماده‌سازی + ارسال یک پیام برای یک اتصال (بدون اشتراک خروجی)."""
+    started = time.monotonic()
+    labels = metric_labels.set((connection_id, media_kind(msg)))
+    # تاخیر انتشار اینجا معنایی ندارد (پیام ممکن است در دور بعدی پایش یا عقب‌افتاده خوانده شود)
+    trace = start_trace(f"{media_kind(msg)} restricted conn={connection_id} msg_id={msg.id}")
+    media = None
+    error = None
+    try:
+        replacer = await get_word_replacer(connection_id)
+        caption = replacer.apply(msg.caption) if msg.caption else None
+        text = replacer.apply(msg.text) if msg.text else None
+
+        with span("prepare"):
+            media = await prepare_media(client, msg, connection_id, watermark_text)
+        with span("send"):
+            sent = await send_with_reuse_fallback(client, msg, dest_chat_id, media, caption, text, reply_to_message_id,
+                                                  connection_id, watermark_text)
+        if sent:
+            metrics.record_transfer(connection_id, media_kind(msg), time.monotonic() - started,
+                                    media_size(msg), output_size(media))
+        return sent
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        finish_trace(trace, error)
+        metric_labels.reset(labels)
+        release_media(media)
+
+class SharedOutputs:
+    """
+    خروجی پردازش یک رسانه را بین همهٔ مقصدهایی که تنظیمات یکسان دارند به اشتراک می‌گذارد.
+    اولین مصرف‌کننده پردازش را شروع می‌کند و بقیه منتظر همان نتیجه می‌مانند؛
+    وقتی آخرین مصرف‌کننده release کند، فایل موقت خروجی پاک می‌شود.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def reserve(self, key, consumers=1):
+        entry = self._entries.setdefault(key, {"task": None, "refs": 0})
+        entry["refs"] += consumers
+
+    async def get(self, key, producer):
+        entry = self._entries[key]
+        if entry["task"] is None:
+            entry["task"] = asyncio.ensure_future(producer())
+        # لغو شدن یک مصرف‌کننده نباید پردازش مشترک را برای بقیه لغو کند
+        return await asyncio.shield(entry["task"])
+
+    def release(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry["refs"] -= 1
+        if entry["refs"] > 0:
+            return
+
+        del self._entries[key]
+        task = entry["task"]
+        if task is not None:
+            task.add_done_callback(_release_shared_task)
+
+def _release_shared_task(task):
+    if not task.cancelled() and task.exception() is None:
+        release_media(task.result())
+
+class DeliveryEngine:
+    """
+    برای هر مقصد یک صف و یک worker دارد: ترتیب پیام‌ها در هر مقصد حفظ می‌شود
+    و مقصدهای مختلف موازی پیش می‌روند، با سقف کلی `concurrency` کار همزمان.
+    worker وقتی صفش خالی شود تمام می‌شود و با پیام بعدی دوباره ساخته می‌شود.
+    """
+
+    def __init__(self, concurrency):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._queues = {}
+        self._workers = {}
+
+    def submit(self, key, job):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue()
+        queue.put_nowait(job)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._worker(key, queue))
+
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def _worker(self, key, queue):
+        try:
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    async with self._semaphore:
+                        await job()
+                except Exception as e:
+                    logger.error(f"⛔️ خطا در صف ارسال مقصد {key}: {e}")
+        finally:
+            self._workers.pop(key, None)
+            self._queues.pop(key, None)
+
+delivery_engine = DeliveryEngine(DELIVERY_CONCURRENCY)
+shared_outputs = SharedOutputs()
+
+def shared_media_key(msg, watermark_text, encode_profile=None):
+    kind = media_kind(msg)
+    if kind == "photo":
+        return (msg.chat.id, msg.id, kind, watermark_text)
+    if kind in ("animation", "video"):
+        return (msg.chat.id, msg.id, kind, watermark_text, encode_profile)
+    if kind == "voice":
+        # صوت پردازش نمی‌شود؛ فقط یک بار برای همهٔ مقصدها دانلود می‌شود
+        return (msg.chat.id, msg.id, kind, None)
+    return None
+
+async def deliver_to_route(client, message, route, media_key):
+    conn_id = route["conn_id"]
+    source_channel = route["source_channel"]
+    destination_channel = route["destination_channel"]
+    started = time.monotonic()
+    labels = metric_labels.set((conn_id, media_kind(message)))
+    trace = start_trace(f"{media_kind(message)} {source_channel} → {destination_channel} msg_id={message.id}", message.date)
+    error = None
+    try:
+        # ریپلای اگر پیام مرجع در مقصد موجود باشد
+        reply_to_message_id = None
+        if message.reply_to_message:
+            with span("reply_lookup"):
+                reply_to_message_id = await get_destination_message_id(conn_id, message.reply_to_message.id)
+
+        media = None
+        plan = await get_transform_plan(conn_id, route["watermark_text"], route["is_restricted"])
+        if plan["copy"]:
+            sent_message = await copy_to_destination(client, message, route["dest_chat_id"], reply_to_message_id)
+        else:
+            # جایگزینی کلمات
+            replacer = await get_word_replacer(conn_id)
+            caption = replacer.apply(message.caption) if message.caption else None
+            text = replacer.apply(message.text) if message.text else None
+
+            if media_key is not None:
+                with span("prepare"):
+                    media = await shared_outputs.get(
+                        media_key, lambda: prepare_media(client, message, conn_id, route["watermark_text"])
+                    )
+
+            with span("send"):
+                sent_message = await send_with_reuse_fallback(client, message, route["dest_chat_id"], media, caption, text,
+                                                              reply_to_message_id, conn_id, route["watermark_text"])
+
+        if sent_message:
+            metrics.record_transfer(conn_id, media_kind(message), time.monotonic() - started,
+                                    media_size(message), output_size(media))
+            await save_transferred_post(conn_id, message.id, sent_message.id)
+            await update_last_scanned_message_id(conn_id, message.id)
+
+            message_type = (
+                "تصویر" if message.photo else
+                "ویدیو" if message.video else
+                "گیف" if message.animation else
+                "صوت" if message.voice else
+                "استیکر" if message.sticker else
+                "متن"
+            )
+            log_details = f"پست {message_type} از {source_channel} به {destination_channel} منتقل شد"
+            await add_activity_log(conn_id, "transfer", log_details)
+
+    except Exception as e:
+        error = e
+        metrics.record_failure(conn_id, media_kind(message))
+        logger.error(f"⛔️ خطا در انتقال پیام از {source_channel} به {destination_channel}: {str(e)}")
+    finally:
+        finish_trace(trace, error)
+        metric_labels.reset(labels)
+        if media_key is not None:
+            shared_outputs.release(media_key)
+
+# آلبوم‌ها: پیام‌های با media_group_id یکسان مدتی جمع و با یک send_media_group فرستاده می‌شوند
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", 1.5))
+ALBUM_MAX_ITEMS = 10
+
+def album_input_media(msg, media, caption):
+    if msg.photo:
+        return InputMediaPhoto(_upload_source(media, "photo.jpg"), caption=caption or "")
+    if msg.video:
+        return InputMediaVideo(_upload_source(media, "video.mp4"), caption=caption or "")
+    return None
+
+def album_copy_media(msg):
+    """عضو آلبوم با file_id خود پیام منبع (بدون دانلود/آپلود) و کپشن و entityهای دست‌نخورده"""
+    kind = InputMediaPhoto if msg.photo else InputMediaVideo
+    return kind(getattr(msg, media_kind(msg)).file_id, caption=msg.caption or "", caption_entities=msg.caption_entities)
+
+async def _send_album(client, messages, chat_id, medias, captions, reply_to_message_id):
+    # هر تلاش (بعد از FloodWait) لیست و BytesIOهای تازه می‌سازد
+    build = lambda: [album_input_media(msg, media, caption) for msg, media, caption in zip(messages, medias, captions)]
+    sent = await send_scheduler.call(client, chat_id, metrics.timed("upload", lambda: client.send_media_group(
+        chat_id, build(), reply_to_message_id=reply_to_message_id)))
+    for media, sent_message in zip(medias, sent):
+        await remember_upload(media, sent_message)
+    return sent
+
+async def send_album(client, messages, chat_id, medias, captions, reply_to_message_id, connection_id, watermark_text):
+    """مثل send_with_reuse_fallback برای آلبوم؛ خروجی لیست پیام‌های مقصد به همان ترتیب ورودی است."""
+    try:
+        return await _send_album(client, messages, chat_id, medias, captions, reply_to_message_id)
+    except BadRequest as e:
+        reused = [i for i, media in enumerate(medias) if media and media.get("file_id")]
+        if not reused:
+            raise
+        logger.warning(f"⚠️ file_id ذخیره‌شده در آلبوم قابل استفاده نبود، پردازش دوباره: {e}")
+        for i in reused:
+            await delete_uploaded_file_id(*medias[i]["reuse_key"])
+
+    fresh = list(medias)
+    owned = []
+    try:
+        for i in reused:
+            fresh[i] = await prepare_media(client, messages[i], connection_id, watermark_text, reuse=False)
+            owned.append(fresh[i])
+        return await _send_album(client, messages, chat_id, fresh, captions, reply_to_message_id)
+    finally:
+        for media in owned:
+            release_media(media)
+
+async def deliver_album_to_route(client, messages, route, media_keys):
+    conn_id = route["conn_id"]
+    source_channel = route["source_channel"]
+    destination_channel = route["destination_channel"]
+    items = [(msg, key) for msg, key in zip(messages, media_keys) if msg.photo or msg.video]
+    if len(items) < 2:
+        # آلبوم سند/صوت یا تک‌عضوی: مثل پیام‌های عادی تک‌تک فرستاده می‌شود
+        for message, media_key in zip(messages, media_keys):
+            await deliver_to_route(client, message, route, media_key)
+        return
+
+    try:
+        plan = await get_transform_plan(conn_id, route["watermark_text"], route["is_restricted"])
+    except Exception as e:
+        # رزروهای shared_outputs باید آزاد شوند وگرنه مقصدهای دیگر تا ابد منتظر می‌مانند
+        for media_key in media_keys:
+            if media_key is not None:
+                shared_outputs.release(media_key)
+        metrics.record_failure(conn_id, "album")
+        logger.error(f"⛔️ خطا در انتقال آلبوم از {source_channel} به {destination_channel}: {str(e)}")
+        return
+    if plan["copy"]:
+        await copy_album_to_route(client, messages, route, media_keys)
+        return
+
+    started = time.monotonic()
+    labels = metric_labels.set((conn_id, "album"))
+    trace = start_trace(f"album({len(items)}) {source_channel} → {destination_channel} msg_id={messages[0].id}",
+                        messages[0].date)
+    error = None
+    try:
+        reply_to_message_id = None
+        if messages[0].reply_to_message:
+            with span("reply_lookup"):
+                reply_to_message_id = await get_destination_message_id(conn_id, messages[0].reply_to_message.id)
+
+        replacer = await get_word_replacer(conn_id)
+        album = [msg for msg, _ in items]
+        captions = [replacer.apply(msg.caption) if msg.caption else None for msg in album]
+
+        # رسانه‌های آلبوم موازی پردازش می‌شوند
+        with span("prepare"):
+            medias = await asyncio.gather(*(
+                shared_outputs.get(key, functools.partial(prepare_media, client, msg, conn_id, route["watermark_text"]))
+                for msg, key in items
+            ))
+
+        with span("send"):
+            sent = await send_album(client, album, route["dest_chat_id"], medias, captions, reply_to_message_id,
+                                    conn_id, route["watermark_text"])
+        metrics.record_transfer(conn_id, "album", time.monotonic() - started, sum(media_size(msg) for msg in album),
+                                sum(output_size(media) for media in medias), count=len(sent))
+
+        await save_transfer_progress(
+            conn_id,
+            [(msg.id, sent_message.id) for msg, sent_message in zip(album, sent)],
+            [("transfer", f"آلبوم {len(sent)} تایی از {source_channel} به {destination_channel} منتقل شد")],
+            max(msg.id for msg in album),
+        )
+    except Exception as e:
+        error = e
+        metrics.record_failure(conn_id, "album")
+        logger.error(f"⛔️ خطا در انتقال آلبوم از {source_channel} به {destination_channel}: {str(e)}")
+    finally:
+        finish_trace(trace, error)
+        metric_labels.reset(labels)
+        for media_key in media_keys:
+            if media_key is not None:
+                shared_outputs.release(media_key)
+
+async def copy_album_to_route(client, messages, route, media_keys):
+    conn_id = route["conn_id"]
+    started = time.monotonic()
+    labels = metric_labels.set((conn_id, "album"))
+    trace = start_trace(f"album({len(messages)}) copy {route['source_channel']} → {route['destination_channel']} "
+                        f"msg_id={messages[0].id}", messages[0].date)
+    error = None
+    try:
+        reply_to_message_id = None
+        if messages[0].reply_to_message:
+            with span("reply_lookup"):
+                reply_to_message_id = await get_destination_message_id(conn_id, messages[0].reply_to_message.id)
+
+        # copy_media_group کل گروه منبع را کپی می‌کند، حتی اگر بافر فقط بخشی از آن را (بعد از
+        # تمام شدن ALBUM_WINDOW) فرستاده باشد؛ پس فقط همین پیام‌ها با file_id خودشان فرستاده می‌شوند
+        album = [msg for msg in messages if msg.photo or msg.video]
+        sent = await send_scheduler.call(client, route["dest_chat_id"], metrics.timed("copy", lambda: client.send_media_group(
+            route["dest_chat_id"], [album_copy_media(msg) for msg in album], reply_to_message_id=reply_to_message_id)))
+        metrics.record_transfer(conn_id, "album", time.monotonic() - started, count=len(sent))
+
+        await save_transfer_progress(
+            conn_id,
+            [(msg.id, sent_message.id) for msg, sent_message in zip(album, sent)],
+            [("transfer", f"آلبوم {len(sent)} تایی از {route['source_channel']} به {route['destination_channel']} کپی شد")],
+            max(msg.id for msg in album),
+        )
+    except Exception as e:
+        error = e
+        metrics.record_failure(conn_id, "album")
+        logger.error(f"⛔️ خطا در کپی آلبوم از {route['source_channel']} به {route['destination_channel']}: {str(e)}")
+    finally:
+        finish_trace(trace, error)
+        metric_labels.reset(labels)
+        for media_key in media_keys:
+            if media_key is not None:
+                shared_outputs.release(media_key)
+
+def submit_deliveries(client, messages, routes):
+    """یک پیام یا یک آلبوم را در صف همهٔ مقصدها می‌گذارد."""
+    for route in routes:
+        media_keys = [shared_media_key(msg, route["watermark_text"], route["encode_profile"]) for msg in messages]
+        for media_key in media_keys:
+            if media_key is not None:
+                shared_outputs.reserve(media_key)
+        if len(messages) == 1:
+            job = functools.partial(deliver_to_route, client, messages[0], route, media_keys[0])
+        else:
+            job = functools.partial(deliver_album_to_route, client, messages, route, media_keys)
+        delivery_engine.submit(route["dest_chat_id"], job)
+
+class AlbumBuffer:
+    """
+    پیام‌های هر کانال را به ترتیب رسیدن نگه می‌دارد تا آلبوم‌های باز کامل شوند
+    (ALBUM_WINDOW ثانیه بدون عضو جدید یا رسیدن به ALBUM_MAX_ITEMS).
+    پیام عادی‌ای که بعد از یک آلبوم باز برسد پشت آن می‌ماند تا ترتیب مقصد به هم نخورد.
+    """
+
+    def __init__(self, window, dispatch):
+        self.window = window
+        self._dispatch = dispatch  # dispatch(client, messages, routes)
+        self._pending = {}  # chat_id -> [item]
+
+    def add(self, client, message, routes):
+        chat_id = message.chat.id
+        items = self._pending.get(chat_id)
+        group_id = message.media_group_id
+        if group_id is None:
+            if not items:
+                self._dispatch(client, [message], routes)
+            else:
+                items.append({"group": None, "messages": [message], "routes": routes, "client": client,
+                              "done": True, "timer": None})
+            return
+
+        if items is None:
+            items = self._pending[chat_id] = []
+        item = next((i for i in items if i["group"] == group_id and not i["done"]), None)
+        if item is None:
+            item = {"group": group_id, "messages": [], "routes": routes, "client": client, "done": False, "timer": None}
+            items.append(item)
+        item["messages"].append(message)
+
+        if item["timer"] is not None:
+            item["timer"].cancel()
+        if len(item["messages"]) >= ALBUM_MAX_ITEMS:
+            self._complete(chat_id, item)
+        else:
+            item["timer"] = asyncio.get_running_loop().call_later(self.window, self._complete, chat_id, item)
+
+    def _complete(self, chat_id, item):
+        item["done"] = True
+        item["timer"] = None
+        items = self._pending.get(chat_id, [])
+        while items and items[0]["done"]:
+            head = items.pop(0)
+            self._dispatch(head["client"], sorted(head["messages"], key=lambda m: m.id), head["routes"])
+        if not items:
+            self._pending.pop(chat_id, None)
+
+album_buffer = AlbumBuffer(ALBUM_WINDOW, submit_deliveries)
 
 # مدیریت پنل ادمین
 @bot.on_message(filters.command("start") & filters.private & filters.user(ADMIN_ID))
@@ -390,6 +2363,7 @@ async def start_command(client, message: Message):
         [InlineKeyboardButton("🖋 مدیریت واترمارک‌ها", callback_data="manage_watermarks")],
         [InlineKeyboardButton("📋 لیست کانال‌های متصل", callback_data="list_connections")],
         [InlineKeyboardButton("📊 وضعیت فعلی ربات", callback_data="bot_status")],
+        [InlineKeyboardButton("📦 کارهای بک‌فیل", callback_data="backfill_jobs")],
         [InlineKeyboardButton("📝 مشاهده لاگ فعالیت‌ها", callback_data="view_logs")]
     ])
     await message.reply(
@@ -411,7 +2385,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
         )
 
     elif data == "list_connections":
-        connections = get_all_connections()
+        connections = await get_all_connections()
         if connections:
             text = "🔄 لیست اتصال‌های فعلی:\n\n"
             buttons = []
@@ -433,7 +2407,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
             await callback_query.message.edit_text("هیچ اتصالی تعریف نشده است.", reply_markup=keyboard)
     
     elif data == "manage_replacements":
-        connections = get_all_connections()
+        connections = await get_all_connections()
         if connections:
             text = "برای مدیریت کلمات جایگزین، اتصال مورد نظر را انتخاب کنید:\n\n"
             buttons = []
@@ -457,13 +2431,8 @@ async def handle_callback(client, callback_query: CallbackQuery):
         conn_id = int(data.split("_")[1])
 
         # دریافت اطلاعات اتصال
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT source_channel, destination_channel FROM channel_connections WHERE id = ?", (conn_id,))
-        connection = cursor.fetchone()
-        cursor.execute("SELECT id, original_word, replacement_word FROM word_replacements WHERE connection_id = ?", (conn_id,))
-        replacements = cursor.fetchall()
-        conn.close()
+        connection = await get_connection_channels(conn_id)
+        replacements = await db.fetchall("SELECT id, original_word, replacement_word FROM word_replacements WHERE connection_id = ?", (conn_id,))
 
         if connection:
             source, dest = connection
@@ -494,18 +2463,14 @@ async def handle_callback(client, callback_query: CallbackQuery):
 
     elif data.startswith("clear_replacements_"):
         conn_id = int(data.split("_")[2])
-        clear_word_replacements(conn_id)
+        await clear_word_replacements(conn_id)
         
         # دریافت اطلاعات اتصال برای نمایش در پیام
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT source_channel, destination_channel FROM channel_connections WHERE id = ?", (conn_id,))
-        connection = cursor.fetchone()
-        conn.close()
+        connection = await get_connection_channels(conn_id)
         
         if connection:
             source, dest = connection
-            add_activity_log(conn_id, "clear_replacements", f"تمام کلمات جایگزین برای اتصال {source} → {dest} پاک شدند")
+            await add_activity_log(conn_id, "clear_replacements", f"تمام کلمات جایگزین برای اتصال {source} → {dest} پاک شدند")
             
             keyboard = InlineKeyboardMarkup([[
                 InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="back_to_main")
@@ -521,11 +2486,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
         word_id = int(parts[1])
         conn_id = int(parts[2])
 
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM word_replacements WHERE id = ?", (word_id,))
-        conn.commit()
-        conn.close()
+        await delete_word_replacement(word_id, conn_id)
 
         await callback_query.answer("✅ کلمه حذف شد.", show_alert=False)
         await handle_callback(client, CallbackQuery(id=callback_query.id, from_user=callback_query.from_user, chat_instance=callback_query.chat_instance, message=callback_query.message, data=f"replace_{conn_id}"))
@@ -535,19 +2496,15 @@ async def handle_callback(client, callback_query: CallbackQuery):
         conn_id = int(data.split("_")[1])
         
         # دریافت اطلاعات اتصال برای نمایش در لاگ
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT source_channel, destination_channel FROM channel_connections WHERE id = ?", (conn_id,))
-        connection = cursor.fetchone()
+        connection = await get_connection_channels(conn_id)
         
         if connection:
             source, dest = connection
             # ثبت لاگ قبل از حذف
-            add_activity_log(conn_id, "delete_connection", f"اتصال {source} → {dest} حذف شد")
+            await add_activity_log(conn_id, "delete_connection", f"اتصال {source} → {dest} حذف شد")
             
         # حذف اتصال
-        delete_connection(conn_id)
-        conn.close()
+        await delete_connection(conn_id)
         
         keyboard = InlineKeyboardMarkup([[
             InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="back_to_main")
@@ -559,40 +2516,51 @@ async def handle_callback(client, callback_query: CallbackQuery):
         )
     
     elif data == "bot_status":
-        # دریافت وضعیت فعلی ربات
-        connections = get_all_connections()
-        recent_logs = get_recent_activity_logs(5)
-        
+        # فقط از متریک‌های درون‌حافظه ساخته می‌شود؛ هیچ کوئری دیتابیسی در این مسیر نیست
+        snapshot = metrics.snapshot()
+        routes = [route for source_routes in routing_index.values() for route in source_routes]
+        labels = {route["conn_id"]: f"{route['source_channel']} → {route['destination_channel']}" for route in routes}
+        gauges = snapshot["gauges"]
+
         text = "📊 وضعیت فعلی ربات:\n\n"
-        text += f"🔄 تعداد اتصال‌های فعال: {len(connections)}\n"
-        text += f"⏱ زمان فعلی سرور: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        
-        if recent_logs:
-            text += "🔍 آخرین فعالیت‌ها:\n"
-            for _, source, dest, action, details, time in recent_logs:
-                action_type = {
-                    "transfer": "انتقال پست",
-                    "edit": "ویرایش پست",
-                    "add_connection": "افزودن اتصال",
-                    "delete_connection": "حذف اتصال",
-                    "add_replacement": "افزودن کلمه جایگزین",
-                    "clear_replacements": "پاک کردن کلمات جایگزین"
-                }.get(action, action)
-                
-                text += f"• {action_type} - {time}: {details}\n"
-        
+        text += f"🔄 تعداد مسیرهای فعال: {len(routes)}\n"
+        text += f"⏱ زمان فعلی سرور: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        text += f"🕰 مدت اجرا: {format_duration(snapshot['uptime'])}\n"
+        text += f"🚀 سرعت انتقال: {snapshot['throughput_1m']:.1f}/دقیقه (۵ دقیقه: {snapshot['throughput_5m']:.1f}/دقیقه)\n"
+        text += (f"📥 صف‌ها: ارسال {gauges.get('delivery_queue')} | ffmpeg {gauges.get('ffmpeg_queue')} | "
+                 f"آلبوم {gauges.get('album_pending')} | بک‌فیل {gauges.get('backfill_jobs')}\n")
+        if snapshot["last_flood_wait"]:
+            chat, seconds, at = snapshot["last_flood_wait"]
+            text += f"⏳ آخرین FloodWait: {seconds} ثانیه روی {chat} ({format_duration(time.time() - at)} پیش)\n"
+
+        if snapshot["latency"]:
+            text += "\n⚡️ میانگین زمان انتقال:\n"
+            for kind, (count, average) in sorted(snapshot["latency"].items()):
+                text += f"• {kind}: {average:.2f} ثانیه ({count} پیام)\n"
+
+        if snapshot["connections"]:
+            text += "\n🔗 اتصال‌ها (از زمان اجرا):\n"
+            for conn_id, stats in sorted(snapshot["connections"].items()):
+                last = format_duration(time.time() - stats["last_transfer"]) + " پیش" if stats["last_transfer"] else "-"
+                text += (f"• {labels.get(conn_id, conn_id)}: {stats['transfers']} انتقال، {stats['failures']} خطا، "
+                         f"{stats['bytes_in'] / 1024 / 1024:.1f}→{stats['bytes_out'] / 1024 / 1024:.1f} MB، آخرین: {last}\n")
+
         keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔄 به‌روزرسانی", callback_data="bot_status"),
             InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="back_to_main")
         ]])
-        
-        await callback_query.message.edit_text(text, reply_markup=keyboard)
+
+        with contextlib.suppress(MessageNotModified):
+            await callback_query.message.edit_text(text, reply_markup=keyboard)
     
     elif data == "view_logs":
-        logs = get_recent_activity_logs(20)
+        logs = await get_recent_activity_logs(20)
+        transfers_24h = sum(count for _, action, count in await get_activity_rollups(24) if action == "transfer")
         
         if logs:
-            text = "📋 آخرین فعالیت‌های ربات:\n\n"
-            for _, source, dest, action, details, time in logs:
+            text = f"📈 انتقال‌های ۲۴ ساعت اخیر: {transfers_24h}\n\n"
+            text += "📋 آخرین فعالیت‌های ربات:\n\n"
+            for _, source, dest, action, details, created_at in logs:
                 action_type = {
                     "transfer": "انتقال پست",
                     "edit": "ویرایش پست",
@@ -602,7 +2570,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
                     "clear_replacements": "پاک کردن کلمات جایگزین"
                 }.get(action, action)
                 
-                text += f"• {time} - {action_type}:\n"
+                text += f"• {created_at} - {action_type}:\n"
                 text += f"  {source} → {dest}: {details}\n\n"
         else:
             text = "هیچ لاگی یافت نشد."
@@ -626,6 +2594,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
             [InlineKeyboardButton("🖋 مدیریت واترمارک‌ها", callback_data="manage_watermarks")],
             [InlineKeyboardButton("📋 لیست کانال‌های متصل", callback_data="list_connections")],
             [InlineKeyboardButton("📊 وضعیت فعلی ربات", callback_data="bot_status")],
+            [InlineKeyboardButton("📦 کارهای بک‌فیل", callback_data="backfill_jobs")],
             [InlineKeyboardButton("📝 مشاهده لاگ فعالیت‌ها", callback_data="view_logs")]
         ])
         await callback_query.message.edit_text(
@@ -637,11 +2606,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
         conn_id = int(data.split("_")[1])
 
         # دریافت اطلاعات اتصال
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT source_channel, destination_channel FROM channel_connections WHERE id = ?", (conn_id,))
-        connection = cursor.fetchone()
-        conn.close()
+        connection = await get_connection_channels(conn_id)
 
         if connection:
             source, dest = connection
@@ -661,7 +2626,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="back_to_main")]])
             )
     elif data == "manage_watermarks":
-        connections = get_all_connections()
+        connections = await get_all_connections()
         if connections:
             text = "🔹 برای مدیریت واترمارک، اتصال موردنظر را انتخاب کنید:\n\n"
             buttons = []
@@ -680,11 +2645,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
     elif data.startswith("watermark_"):
         conn_id = int(data.split("_")[1])
 
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT source_channel, destination_channel, watermark_text FROM channel_connections WHERE id = ?", (conn_id,))
-        connection = cursor.fetchone()
-        conn.close()
+        connection = await db.fetchone("SELECT source_channel, destination_channel, watermark_text FROM channel_connections WHERE id = ?", (conn_id,))
 
         if connection:
             source, dest, current_watermark = connection
@@ -697,11 +2658,35 @@ async def handle_callback(client, callback_query: CallbackQuery):
             buttons = [
                 [InlineKeyboardButton("✏️ تغییر واترمارک", callback_data=f"setwatermark_{conn_id}")],
                 [InlineKeyboardButton("🗑 حذف واترمارک", callback_data=f"delwatermark_{conn_id}")],
+                [InlineKeyboardButton("🎞 پروفایل انکود ویدیو", callback_data=f"encode_{conn_id}")],
                 [InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="back_to_main")]
             ]
 
             await callback_query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons), parse_mode=ParseMode.MARKDOWN)
 
+    elif data.startswith(("encode_", "setencode_")):
+        parts = data.split("_")
+        conn_id = int(parts[1])
+        if parts[0] == "setencode" and parts[2] in ENCODE_PROFILES:
+            await set_connection_encode_profile(conn_id, parts[2])
+            await add_activity_log(conn_id, "encode_profile", f"پروفایل انکود به {parts[2]} تغییر کرد")
+            await callback_query.answer("پروفایل انکود ذخیره شد.")
+
+        current = await get_connection_encode_profile(conn_id)
+        text = "🎞 پروفایل انکود ویدیو/گیف این اتصال را انتخاب کنید:\n"
+        buttons = []
+        for name, profile in ENCODE_PROFILES.items():
+            mark = "✅ " if name == current else ""
+            height = f"{profile['max_height']}p" if profile["max_height"] else "اصلی"
+            text += f"\n{mark}{name}: preset={profile['preset']} | crf={profile['crf']} | حداکثر {height}"
+            buttons.append([InlineKeyboardButton(f"{mark}{name}", callback_data=f"setencode_{conn_id}_{name}")])
+        buttons.append([InlineKeyboardButton("بازگشت", callback_data=f"watermark_{conn_id}")])
+        try:
+            await callback_query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+        except BadRequest:
+            # متن تغییری نکرده (MESSAGE_NOT_MODIFIED)
+            pass
+
     elif data.startswith("setwatermark_"):
         conn_id = int(data.split("_")[1])
         user_states[callback_query.from_user.id] = {
@@ -715,14 +2700,14 @@ async def handle_callback(client, callback_query: CallbackQuery):
 
     elif data.startswith("delwatermark_"):
         conn_id = int(data.split("_")[1])
-        set_connection_watermark(conn_id, None)
+        await set_connection_watermark(conn_id, None)
         await callback_query.message.edit_text(
             "✅ واترمارک اتصال حذف شد.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="back_to_main")]])
         )
 
     elif data == "test_connection":
-        connections = get_all_connections()
+        connections = await get_all_connections()
         if connections:
             buttons = []
             for conn_id, source, dest in connections:
@@ -741,11 +2726,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
     elif data.startswith("test_"):
         conn_id = int(data.split("_")[1])
 
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT source_channel, destination_channel FROM channel_connections WHERE id = ?", (conn_id,))
-        connection = cursor.fetchone()
-        conn.close()
+        connection = await get_connection_channels(conn_id)
 
         if not connection:
             await callback_query.message.reply("❌ اتصال مورد نظر یافت نشد.")
@@ -754,8 +2735,8 @@ async def handle_callback(client, callback_query: CallbackQuery):
         source_channel, dest_channel = connection
 
         try:
-            source_chat = await user.get_chat(source_channel)
-            dest_chat = await user.get_chat(dest_channel)
+            source_chat = await resolve_chat(user, source_channel, refresh=True)
+            dest_chat = await resolve_chat(user, dest_channel, refresh=True)
 
             last_msg = None
             async for msg in user.get_chat_history(source_chat.id, limit=1):
@@ -768,15 +2749,21 @@ async def handle_callback(client, callback_query: CallbackQuery):
 
             sent = None
             if last_msg.text:
-                sent = await user.send_message(dest_chat.id, last_msg.text)
+                sent = await send_scheduler.call(user, dest_chat.id, lambda: user.send_message(dest_chat.id, last_msg.text))
             elif last_msg.photo:
                 photo_file = await user.download_media(last_msg.photo, in_memory=True)
-                sent = await user.send_photo(dest_chat.id, photo_file, caption=last_msg.caption)
+
+                async def _send_test_photo():
+                    photo_file.seek(0)
+                    return await user.send_photo(dest_chat.id, photo_file, caption=last_msg.caption)
+
+                sent = await send_scheduler.call(user, dest_chat.id, _send_test_photo)
             else:
                 await callback_query.message.reply("⚠️ پیام آخر منبع فقط از نوع متن یا عکس باید باشد.")
                 return
 
-            test_msg = await user.send_message(dest_chat.id, "🧪 این یک پیام تست است و تا ۵ ثانیه دیگر حذف خواهد شد.")
+            test_msg = await send_scheduler.call(user, dest_chat.id, lambda: user.send_message(
+                dest_chat.id, "🧪 این یک پیام تست است و تا ۵ ثانیه دیگر حذف خواهد شد."))
             await asyncio.sleep(5)
             await user.delete_messages(dest_chat.id, [sent.id, test_msg.id])
 
@@ -798,23 +2785,12 @@ async def handle_callback(client, callback_query: CallbackQuery):
         is_restricted = 1 if data == "restricted_yes" else 0
 
         # افزودن اتصال اولیه
-        conn_id = add_channel_connection(source, destination)
-
-        # به‌روزرسانی فیلد is_restricted
-        conn = sqlite3.connect("transfer_bot.db")
-        cursor = conn.cursor()
-
-        # اطمینان از وجود ستون
-        try:
-            cursor.execute("ALTER TABLE channel_connections ADD COLUMN is_restricted INTEGER DEFAULT 0")
-        except:
-            pass  # ستون از قبل وجود داشته
+        conn_id = await add_channel_connection(source, destination)
 
-        cursor.execute("UPDATE channel_connections SET is_restricted = ? WHERE id = ?", (is_restricted, conn_id))
-        conn.commit()
-        conn.close()
+        # به‌روزرسانی فیلد is_restricted (ستون در create_database مهاجرت داده می‌شود)
+        await set_connection_restricted(conn_id, bool(is_restricted))
 
-        add_activity_log(conn_id, "add_connection", f"اتصال {source} → {destination} ثبت شد (محدود: {'بله' if is_restricted else 'خیر'}).")
+        await add_activity_log(conn_id, "add_connection", f"اتصال {source} → {destination} ثبت شد (محدود: {'بله' if is_restricted else 'خیر'}).")
 
         await callback_query.message.edit_text(
             f"✅ اتصال با موفقیت ثبت شد!\n\n"
@@ -826,7 +2802,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
         user_states.pop(callback_query.from_user.id, None)
     
     elif data == "manage_connections":
-        conns = get_all_connections()
+        conns = await get_all_connections()
         if not conns:
             await callback_query.message.edit_text(
                 "هیچ اتصالی تعریف نشده.",
@@ -835,11 +2811,7 @@ async def handle_callback(client, callback_query: CallbackQuery):
             return
 
         # واکشی وضعیت فعال بودن
-        conn = sqlite3.connect('transfer_bot.db')
-        cur = conn.cursor()
-        cur.execute("SELECT id, is_active FROM channel_connections")
-        status_map = {row[0]: row[1] for row in cur.fetchall()}
-        conn.close()
+        status_map = {row[0]: row[1] for row in await db.fetchall("SELECT id, is_active FROM channel_connections")}
 
         text = "⚙️ مدیریت اتصال‌ها:\n"
         buttons = []
@@ -859,14 +2831,14 @@ async def handle_callback(client, callback_query: CallbackQuery):
 
     elif data.startswith("toggle_"):
         conn_id = int(data.split("_")[1])
-        row = get_connection_by_id(conn_id)
+        row = await get_connection_by_id(conn_id)
         if not row:
             await callback_query.answer("اتصال یافت نشد.", show_alert=True)
             return
         _, source, dest, is_active, _ = row
         new_state = not bool(is_active)
-        set_connection_active(conn_id, new_state)
-        add_activity_log(conn_id, "toggle_connection", f"{'فعال' if new_state else 'غیرفعال'} شد: {source} → {dest}")
+        await set_connection_active(conn_id, new_state)
+        await add_activity_log(conn_id, "toggle_connection", f"{'فعال' if new_state else 'غیرفعال'} شد: {source} → {dest}")
         await callback_query.answer("وضعیت به‌روزرسانی شد.")
         await handle_callback(client, CallbackQuery(
             id=callback_query.id, from_user=callback_query.from_user,
@@ -874,27 +2846,66 @@ async def handle_callback(client, callback_query: CallbackQuery):
             message=callback_query.message, data="manage_connections"
         ))
 
+    elif data == "backfill_jobs":
+        jobs = await get_backfill_jobs(limit=10)
+        if not jobs:
+            await callback_query.message.edit_text(
+                "هیچ کار بک‌فیلی ثبت نشده.\nاز «مدیریت اتصال‌ها» می‌توانید بک‌فیل را شروع کنید.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="back_to_main")]])
+            )
+            return
+        text = "📦 کارهای بک‌فیل اخیر:\n"
+        buttons = []
+        for job in jobs:
+            label = BACKFILL_STATUS_LABELS.get(job["status"], job["status"])
+            text += f"\n#{job['id']} اتصال {job['connection_id']} | {label} | منتقل‌شده: {job['transferred_count']}"
+            buttons.append([InlineKeyboardButton(f"#{job['id']} اتصال {job['connection_id']}", callback_data=f"bfjob_{job['id']}")])
+        buttons.append([InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="back_to_main")])
+        await callback_query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+
+    elif data.startswith(("bfjob_", "bfpause_", "bfresume_", "bfcancel_")):
+        action, job_id = data.split("_")
+        job = await get_backfill_job(int(job_id))
+        if not job:
+            await callback_query.answer("کار بک‌فیل یافت نشد.", show_alert=True)
+            return
+
+        if action == "bfpause" and job["status"] == "running":
+            await stop_backfill_job(job["id"], "paused")
+            await callback_query.answer("بک‌فیل متوقف شد.")
+        elif action == "bfresume" and job["status"] == "paused":
+            await set_backfill_job_status(job["id"], "running")
+            start_backfill_job(job["id"], job["connection_id"])
+            await callback_query.answer("بک‌فیل ادامه پیدا کرد.")
+        elif action == "bfcancel" and job["status"] in ("running", "paused"):
+            await stop_backfill_job(job["id"], "cancelled")
+            await callback_query.answer("بک‌فیل لغو شد.")
+
+        job = await get_backfill_job(job["id"])
+        channels = await get_connection_channels(job["connection_id"])
+        source, dest = channels if channels else (None, None)
+        try:
+            await callback_query.message.edit_text(render_backfill_job(job, source, dest), reply_markup=backfill_job_keyboard(job))
+        except BadRequest:
+            # متن تغییری نکرده (MESSAGE_NOT_MODIFIED)
+            await callback_query.answer()
+
     elif data.startswith("backfill_"):
         conn_id = int(data.split("_")[1])
-        row = get_connection_by_id(conn_id)
+        row = await get_connection_by_id(conn_id)
         if not row:
             await callback_query.answer("اتصال یافت نشد.", show_alert=True)
             return
-        await callback_query.message.edit_text("⏳ شروع بک‌فیل از ابتدا. از تکرار جلوگیری می‌شود...")
-        try:
-            transferred, scanned_upto = await backfill_connection(conn_id, from_start=True)
-            await callback_query.message.edit_text(
-                f"✅ بک‌فیل تمام شد.\n"
-                f"پیام منتقل‌شده: {transferred}\n"
-                f"آخرین پیام اسکن‌شده: {scanned_upto}\n",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("بازگشت", callback_data="manage_connections")]])
-            )
-        except Exception as e:
-            await callback_query.message.edit_text(
-                f"❌ خطا در بک‌فیل:\n<code>{e}</code>",
-                parse_mode=ParseMode.HTML,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("بازگشت", callback_data="manage_connections")]])
-            )
+        _, source, dest, _, _ = row
+
+        # برای هر اتصال فقط یک کار باز؛ اگر هست همان نمایش داده می‌شود
+        job = await get_open_backfill_job(conn_id)
+        if job is None:
+            job_id = await create_backfill_job(conn_id)
+            await add_activity_log(conn_id, "backfill", f"بک‌فیل #{job_id} شروع شد: {source} → {dest}")
+            start_backfill_job(job_id, conn_id)
+            job = await get_backfill_job(job_id)
+        await callback_query.message.edit_text(render_backfill_job(job, source, dest), reply_markup=backfill_job_keyboard(job))
 
 # افزودن اتصال جدید
 @bot.on_message(filters.command("add") & filters.private & filters.user(ADMIN_ID))
@@ -904,14 +2915,14 @@ async def add_connection_command(client, message):
         
         # بررسی اعتبار کانال‌ها
         try:
-            source_info = await user.get_chat(source_channel)
-            dest_info = await user.get_chat(destination_channel)
+            source_info = await resolve_chat(user, source_channel, refresh=True)
+            dest_info = await resolve_chat(user, destination_channel, refresh=True)
             
             # افزودن اتصال به دیتابیس
-            connection_id = add_channel_connection(source_channel, destination_channel)
+            connection_id = await add_channel_connection(source_channel, destination_channel)
             
             # ثبت در لاگ فعالیت‌ها
-            add_activity_log(connection_id, "add_connection", f"اتصال از {source_channel} به {destination_channel} اضافه شد")
+            await add_activity_log(connection_id, "add_connection", f"اتصال از {source_channel} به {destination_channel} اضافه شد")
             
             keyboard = InlineKeyboardMarkup([
                 [InlineKeyboardButton("افزودن کلمات جایگزین", callback_data=f"replace_{connection_id}")],
@@ -945,22 +2956,18 @@ async def add_replacement_command(client, message):
         conn_id = int(conn_id_str)
         
         # بررسی وجود اتصال
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT source_channel, destination_channel FROM channel_connections WHERE id = ?", (conn_id,))
-        connection = cursor.fetchone()
-        conn.close()
+        connection = await get_connection_channels(conn_id)
         
         if not connection:
             await message.reply(f"❌ اتصالی با شناسه {conn_id} یافت نشد.")
             return
         
         # افزودن کلمه جایگزین
-        add_word_replacement(conn_id, original_word, replacement_word)
+        await add_word_replacement(conn_id, original_word, replacement_word)
         
         # ثبت در لاگ فعالیت‌ها
         source, dest = connection
-        add_activity_log(conn_id, "add_replacement", f"کلمه '{original_word}' به '{replacement_word}' در اتصال {source} → {dest} اضافه شد")
+        await add_activity_log(conn_id, "add_replacement", f"کلمه '{original_word}' به '{replacement_word}' در اتصال {source} → {dest} اضافه شد")
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("مدیریت کلمات بیشتر", callback_data=f"replace_{conn_id}")],
@@ -985,138 +2992,40 @@ async def add_replacement_command(client, message):
 # گوش دادن به پیام‌های کانال‌های مبدا و انتقال آنها
 @user.on_message(filters.channel)
 async def handle_channel_messages(client, message: Message):
-    connections = get_active_connections()  # فقط فعال‌ها
-    source_chat_id = message.chat.id
-
-    for conn_id, source_channel, destination_channel in connections:
-        try:
-            source_chat = await client.get_chat(source_channel)
-            if source_chat.id != source_chat_id:
-                continue
-
-            dest_chat = await client.get_chat(destination_channel)
-
-            # ریپلای اگر پیام مرجع در مقصد موجود باشد
-            reply_to_message_id = None
-            if message.reply_to_message:
-                reply_to_message_id = get_destination_message_id(conn_id, message.reply_to_message.id)
-
-            # جایگزینی کلمات
-            caption = replace_words(message.caption, conn_id) if message.caption else None
-            text = replace_words(message.text, conn_id) if message.text else None
-
-            sent_message = None
-
-            if message.photo:
-                photo_file = await client.download_media(message.photo, in_memory=True)
-                image = Image.open(io.BytesIO(photo_file.getvalue())).convert("RGBA")
-                width, height = image.size
-
-                watermark_text = get_connection_watermark(conn_id) or (f"@{dest_chat.username}" if getattr(dest_chat, "username", None) else "")
-
-                txt_layer = Image.new("RGBA", image.size, (255, 255, 255, 0))
-                draw = ImageDraw.Draw(txt_layer)
-
-                try:
-                    font = ImageFont.truetype("Impact.ttf", 70)
-                except IOError:
-                    font = ImageFont.load_default()
-
-                margin_x = 70 * 4
-                margin_y = 70 * 4
-
-                for x in range(0, width, margin_x):
-                    for y in range(0, height, margin_y):
-                        draw.text((x, y), watermark_text, font=font, fill=(255, 255, 255, 128))
-
-                txt_layer = txt_layer.filter(ImageFilter.GaussianBlur(radius=1.5))
-                combined = Image.alpha_composite(image, txt_layer)
-
-                output = io.BytesIO()
-                combined.convert("RGB").save(output, format="JPEG")
-                output.seek(0)
-
-                sent_message = await client.send_photo(
-                    chat_id=dest_chat.id,
-                    photo=output,
-                    caption=caption,
-                    reply_to_message_id=reply_to_message_id
-                )
-
-            elif message.animation:
-                animation_file = await client.download_media(message.animation, in_memory=True)
-                watermark_text = get_connection_watermark(conn_id) or (f"@{dest_chat.username}" if getattr(dest_chat, "username", None) else "")
-                try:
-                    watermarked_gif_bytes = add_text_watermark_to_video(animation_file.getvalue(), watermark_text, is_gif=True)
-                    sent_message = await client.send_animation(
-                        chat_id=dest_chat.id,
-                        animation=watermarked_gif_bytes,
-                        caption=text or "",
-                        parse_mode=ParseMode.HTML,
-                        reply_to_message_id=reply_to_message_id
-                    )
-                except Exception:
-                    sent_message = await client.send_animation(
-                        chat_id=dest_chat.id,
-                        animation=animation_file,
-                        caption=text or "",
-                        parse_mode=ParseMode.HTML,
-                        reply_to_message_id=reply_to_message_id
-                    )
-
-            elif message.video:
-                video_file = await client.download_media(message.video, in_memory=True)
-                watermark_text = get_connection_watermark(conn_id) or (f"@{dest_chat.username}" if getattr(dest_chat, "username", None) else "")
-                watermarked = add_text_watermark_to_video(video_file.getvalue(), watermark_text)
-
-                sent_message = await client.send_video(
-                    chat_id=dest_chat.id,
-                    video=io.BytesIO(watermarked),
-                    caption=caption,
-                    reply_to_message_id=reply_to_message_id
-                )
-
-            elif message.sticker:
-                sent_message = await client.send_sticker(
-                    chat_id=dest_chat.id,
-                    sticker=message.sticker.file_id,
-                    reply_to_message_id=reply_to_message_id
-                )
-
-            elif text:
-                sent_message = await client.send_message(
-                    chat_id=dest_chat.id,
-                    text=text,
-                    reply_to_message_id=reply_to_message_id
-                )
-
-            elif message.voice:
-                voice_file = await client.download_media(message.voice, in_memory=True)
-                sent_message = await client.send_voice(
-                    chat_id=dest_chat.id,
-                    voice=voice_file,
-                    caption=caption,
-                    reply_to_message_id=reply_to_message_id
-                )
+    # فقط مسیرهای فعالِ همین منبع، بدون هیچ درخواست شبکه‌ای
+    routes = await get_routes(client, message.chat.id)
+    for conn_id in restricted_sources.get(message.chat.id, ()):
+        wake_restricted_worker(conn_id)
+    if not routes:
+        return
 
-            if sent_message:
-                save_transferred_post(conn_id, message.id, sent_message.id)
-                update_last_scanned_message_id(conn_id, message.id)
-
-                message_type = (
-                    "تصویر" if message.photo else
-                    "ویدیو" if message.video else
-                    "گیف" if message.animation else
-                    "صوت" if message.voice else
-                    "استیکر" if message.sticker else
-                    "متن"
-                )
-                log_details = f"پست {message_type} از {source_channel} به {destination_channel} منتقل شد"
-                add_activity_log(conn_id, "transfer", log_details)
+    # هر مقصد صف مرتب خودش را دارد؛ این handler فقط کارها را در صف (یا بافر آلبوم) می‌گذارد و برمی‌گردد
+    album_buffer.add(client, message, routes)
+
+# نمایش traceهای پست‌های کند: /slow [تعداد]
+def render_slow_posts(limit=5):
+    if SLOW_POST_SECONDS <= 0:
+        return "ردیابی پست‌های کند غیرفعال است (SLOW_POST_SECONDS=0)."
+    if not slow_posts:
+        return f"🐢 هیچ پستی بیشتر از {SLOW_POST_SECONDS:g} ثانیه طول نکشیده است."
+
+    text = f"🐢 آخرین پست‌های کند (آستانه {SLOW_POST_SECONDS:g} ثانیه):\n"
+    for entry in list(slow_posts)[-limit:][::-1]:
+        text += f"\n• {datetime.fromtimestamp(entry['at']).strftime('%H:%M:%S')} {entry['label']}\n"
+        text += f"  کل: {entry['delay'] + entry['total']:.1f}s (پردازش {entry['total']:.1f}s، قبل از شروع {entry['delay']:.1f}s)\n"
+        for name, count, seconds in summarize_spans(entry["spans"]):
+            text += f"  {name} ×{count}: {seconds:.2f}s\n"
+        if entry["error"]:
+            text += f"  ❌ {entry['error']}\n"
+    return text
 
-        except Exception as e:
-            logger.error(f"⛔️ خطا در انتقال پیام از {source_channel} به {destination_channel}: {str(e)}")
-           
+@bot.on_message(filters.command("slow") & filters.private & filters.user(ADMIN_ID))
+async def slow_posts_command(client, message):
+    parts = message.text.split()
+    limit = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 5
+    text = render_slow_posts(limit)
+    # سقف طول پیام تلگرام
+    await message.reply(text if len(text) <= 4000 else text[:4000] + "\n…")
 
 # محدود کردن دسترسی به ربات فقط برای ادمین
 @bot.on_message(filters.private & ~filters.user(ADMIN_ID))
@@ -1194,8 +3103,8 @@ async def handle_admin_messages(client, message: Message):
         conn_id = state["conn_id"]
         original_word = state["original_word"]
 
-        add_word_replacement(conn_id, original_word, replacement_word)
-        add_activity_log(conn_id, "add_replacement", f"کلمه '{original_word}' → '{replacement_word}' برای اتصال {state['source']} → {state['dest']} افزوده شد.")
+        await add_word_replacement(conn_id, original_word, replacement_word)
+        await add_activity_log(conn_id, "add_replacement", f"کلمه '{original_word}' → '{replacement_word}' برای اتصال {state['source']} → {state['dest']} افزوده شد.")
 
         await message.reply(
             f"✅ موفقیت‌آمیز!\n\n"
@@ -1210,7 +3119,7 @@ async def handle_admin_messages(client, message: Message):
     if state["step"] == "waiting_watermark_text":
         watermark_text = text
         conn_id = state["conn_id"]
-        set_connection_watermark(conn_id, watermark_text)
+        await set_connection_watermark(conn_id, watermark_text)
 
         await message.reply(
             f"✅ واترمارک با موفقیت تغییر یافت به: `{watermark_text}`",
@@ -1226,6 +3135,8 @@ async def handle_admin_messages(client, message: Message):
 async def main():
     # ایجاد دیتابیس اگر وجود نداشته باشد
     create_database()
+    media_cache.reset()
+    activity_log_writer.start()
     
     # شروع کلاینت ربات
     await bot.start()
@@ -1234,259 +3145,543 @@ async def main():
     # ورود به حساب کاربری تلگرام
     await user.start()
     logger.info("کلاینت کاربری متصل شد")
+
+    # ساخت ایندکس مسیریابی پیش از دریافت اولین پیام
+    await rebuild_routing_index(user)
     
     loop.create_task(check_restricted_channels_loop())
+    await resume_backfill_jobs()
+
+    metrics_server = await start_metrics_server() if METRICS_PORT else None
 
     # منتظر ماندن برای سیگنال خروج
     await idle()
     
+    if metrics_server:
+        metrics_server.close()
+
     # خروج از ربات و حساب کاربری
     await bot.stop()
     await user.stop()
+    await activity_log_writer.close()
+    await db.close()
+
+# پایش کانال‌های محدود: هر بار همهٔ پیام‌های بعد از last_scanned منتقل می‌شوند و فاصلهٔ بررسی
+# برای کانال فعال کوتاه و برای کانال ساکت به‌تدریج بلند می‌شود
+RESTRICTED_POLL_MIN = float(os.getenv("RESTRICTED_POLL_MIN", 5))
+RESTRICTED_POLL_MAX = float(os.getenv("RESTRICTED_POLL_MAX", 120))
+RESTRICTED_POLL_BACKOFF = 1.5
+RESTRICTED_MAX_ATTEMPTS = int(os.getenv("RESTRICTED_MAX_ATTEMPTS", 3))
+
+def next_poll_interval(current, transferred):
+    if transferred:
+        return RESTRICTED_POLL_MIN
+    return min(RESTRICTED_POLL_MAX, max(current, RESTRICTED_POLL_MIN) * RESTRICTED_POLL_BACKOFF)
+
+async def poll_restricted_connection(conn_id, source, destination, failures=None) -> int:
+    """
+    همهٔ پیام‌های جدیدتر از last_scanned_message_id را به ترتیب منتقل می‌کند و تعدادشان را برمی‌گرداند.
+    اتصال تازه (cursor صفر) فقط به آخرین پیام فعلی مقداردهی می‌شود؛ انتقال تاریخچه کار بک‌فیل است.
+    با خطای یک پیام، cursor همان‌جا می‌ماند و دور بعد از همان پیام امتحان می‌شود؛ پیامی که
+    RESTRICTED_MAX_ATTEMPTS بار ناموفق بماند (شمارش در failures: msg_id -> تعداد) رد می‌شود.
+    """
+    failures = {} if failures is None else failures
+    cursor = await get_last_scanned_message_id(conn_id)
+    src_chat = await resolve_chat(user, source)
+    if not cursor:
+        async for newest in user.get_chat_history(src_chat.id, limit=1):
+            await update_last_scanned_message_id(conn_id, newest.id)
+        return 0
+
+    dest_chat = None
+    watermark_text = None
+    transferred = 0
+    async for page in iter_history_ascending(user, src_chat.id, cursor):
+        done = await get_transferred_message_ids(conn_id, [m.id for m in page])
+        for msg in page:
+            if msg.id not in done:
+                if dest_chat is None:
+                    dest_chat = await resolve_chat(user, destination)
+                    watermark_text = default_watermark_text(await get_connection_watermark(conn_id), getattr(dest_chat, "username", None))
+
+                reply_to_message_id = None
+                if msg.reply_to_message_id:
+                    reply_to_message_id = done.get(msg.reply_to_message_id) or \
+                        await get_destination_message_id(conn_id, msg.reply_to_message_id)
 
-async def check_restricted_channels_loop():
-    while True:
-        await asyncio.sleep(60)
-
-        conn = sqlite3.connect('transfer_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, source_channel, destination_channel FROM channel_connections WHERE is_restricted = 1")
-        restricted_connections = cursor.fetchall()
-        conn.close()
-
-        for conn_id, source, destination in restricted_connections:
-            try:
-                async for msg in user.get_chat_history(source, limit=15):
-                    if get_destination_message_id(conn_id, msg.id):
-                        break  # این پیام قبلاً منتقل شده
-
-                    dest_chat = await user.get_chat(destination)
-                    caption = replace_words(msg.caption, conn_id) if msg.caption else None
-                    text = replace_words(msg.text, conn_id) if msg.text else None
-                    watermark_text = get_connection_watermark(conn_id) or f"@{dest_chat.username}"
-                    reply_to_message_id = None
-
-                    if msg.reply_to_message:
-                        try:
-                            reply_to_message_id = get_destination_message_id(conn_id, msg.reply_to_message.id)
-                        except:
-                            reply_to_message_id = None  # اگر ریپلای ناقص بود، نادیده بگیر
-
+                try:
+                    sent = await transfer_message(user, msg, conn_id, dest_chat.id, watermark_text, reply_to_message_id)
+                except FloodWait:
+                    # cursor جلو نمی‌رود تا همین پیام در دور بعد دوباره امتحان شود
+                    raise
+                except Exception as e:
+                    metrics.record_failure(conn_id, media_kind(msg))
+                    attempts = failures[msg.id] = failures.get(msg.id, 0) + 1
+                    if attempts < RESTRICTED_MAX_ATTEMPTS:
+                        logger.warning(f"⚠️ انتقال پست محدود msg_id={msg.id} ناموفق بود (تلاش {attempts}): {e}")
+                        return transferred
+                    failures.pop(msg.id, None)
                     sent = None
+                    await add_activity_log(conn_id, "error", f"انتقال پست محدود msg_id={msg.id} بعد از {attempts} تلاش رد شد: {e}")
 
-                    if msg.photo:
-                        photo_file = await user.download_media(msg.photo, in_memory=True)
-                        image = Image.open(io.BytesIO(photo_file.getvalue())).convert("RGBA")
-                        width, height = image.size
-
-                        txt_layer = Image.new("RGBA", image.size, (255, 255, 255, 0))
-                        draw = ImageDraw.Draw(txt_layer)
-
-                        try:
-                            font = ImageFont.truetype("Impact.ttf", 70)
-                        except IOError:
-                            font = ImageFont.load_default()
-
-                        margin_x = 70 * 4
-                        margin_y = 70 * 4
-
-                        for x in range(0, width, margin_x):
-                            for y in range(0, height, margin_y):
-                                draw.text((x, y), watermark_text, font=font, fill=(255, 255, 255, 128))
-
-                        txt_layer = txt_layer.filter(ImageFilter.GaussianBlur(radius=1.5))
-                        combined = Image.alpha_composite(image, txt_layer)
-
-                        output = io.BytesIO()
-                        combined.convert("RGB").save(output, format="JPEG")
-                        output.seek(0)
-
-                        sent = await user.send_photo(chat_id=dest_chat.id, photo=output, caption=caption, reply_to_message_id=reply_to_message_id)
-
-                    elif msg.video:
-                        video_file = await user.download_media(msg.video, in_memory=True)
-                        watermarked = add_text_watermark_to_video(video_file.getvalue(), watermark_text)
-                        sent = await user.send_video(chat_id=dest_chat.id, video=io.BytesIO(watermarked), caption=caption, reply_to_message_id=reply_to_message_id)
-
-                    elif msg.animation:
-                        animation_file = await user.download_media(msg.animation, in_memory=True)
-                        gif = Image.open(io.BytesIO(animation_file.getvalue()))
-
-                        frames = []
-                        try:
-                            font_size = max(30, gif.width // 15)
-                            font = ImageFont.truetype("Impact.ttf", font_size)
-                        except IOError:
-                            font = ImageFont.load_default()
-
-                        margin_x = font_size * 2
-                        margin_y = font_size * 2
-
-                        for frame in ImageSequence.Iterator(gif):
-                            frame = frame.convert("RGBA")
-                            txt_layer = Image.new('RGBA', frame.size, (255, 255, 255, 0))
-                            draw = ImageDraw.Draw(txt_layer)
-
-                            for x in range(0, frame.width, margin_x):
-                                for y in range(0, frame.height, margin_y):
-                                    draw.text((x, y), watermark_text, font=font, fill=(255, 255, 255, 128))
-
-                            txt_layer = txt_layer.filter(ImageFilter.GaussianBlur(radius=1))
-                            combined = Image.alpha_composite(frame, txt_layer)
-                            frames.append(combined)
-
-                        output = io.BytesIO()
-                        frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:], loop=0, duration=gif.info.get('duration', 100))
-                        output.seek(0)
-
-                        sent = await user.send_animation(chat_id=dest_chat.id, animation=output, caption=caption, reply_to_message_id=reply_to_message_id)
+                if sent:
+                    await save_transferred_post(conn_id, msg.id, sent.id)
+                    await add_activity_log(conn_id, "transfer", f"پست محدود از {source} به {destination} منتقل شد.")
+                    done[msg.id] = sent.id
+                    transferred += 1
+
+            await update_last_scanned_message_id(conn_id, msg.id)
+    return transferred
+
+# هر اتصال محدود task و زمان‌بندی مستقل خودش را دارد؛ سمافور سراسری تعداد بررسی‌های همزمان را محدود می‌کند
+RESTRICTED_CONCURRENCY = int(os.getenv("RESTRICTED_CONCURRENCY", 4))
+RESTRICTED_SUPERVISOR_INTERVAL = 30
+restricted_poll_semaphore = asyncio.Semaphore(RESTRICTED_CONCURRENCY)
+restricted_poll_state = {"waiting": 0, "polling": 0}  # برای gaugeهای متریک
+restricted_wakeups = {}  # conn_id -> asyncio.Event؛ با رسیدن پیام لحظه‌ای از منبع set می‌شود
+
+def wake_restricted_worker(conn_id):
+    wakeup = restricted_wakeups.get(conn_id)
+    if wakeup is not None:
+        wakeup.set()
+
+async def restricted_connection_worker(conn_id, source, destination):
+    interval = RESTRICTED_POLL_MIN
+    failures = {}
+    wakeup = restricted_wakeups[conn_id] = asyncio.Event()
+    try:
+        while True:
+            restricted_poll_state["waiting"] += 1
+            try:
+                await restricted_poll_semaphore.acquire()
+            finally:
+                restricted_poll_state["waiting"] -= 1
+            restricted_poll_state["polling"] += 1
+            # پیامی که در حین این دور برسد دور بعدی را فوراً شروع می‌کند
+            wakeup.clear()
+            flood_wait = False
+            try:
+                transferred = await poll_restricted_connection(conn_id, source, destination, failures)
+                interval = next_poll_interval(interval, transferred)
+            except FloodWait as fw:
+                logger.warning(f"⏳ FloodWait {fw.value}s برای اتصال محدود {source} → {destination}")
+                interval = max(interval, int(fw.value) + 1)
+                flood_wait = True
+            except Exception as e:
+                logger.error(f"⛔️ خطا در بررسی اتصال محدود {source} → {destination}: {e}")
+                interval = RESTRICTED_POLL_MAX
+            finally:
+                restricted_poll_state["polling"] -= 1
+                restricted_poll_semaphore.release()
 
-                    elif msg.sticker:
-                        sent = await user.send_sticker(chat_id=dest_chat.id, sticker=msg.sticker.file_id, reply_to_message_id=reply_to_message_id)
+            if flood_wait:
+                await asyncio.sleep(interval)
+            else:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(wakeup.wait(), interval)
+    finally:
+        if restricted_wakeups.get(conn_id) is wakeup:
+            del restricted_wakeups[conn_id]
 
-                    elif text:
-                        sent = await user.send_message(chat_id=dest_chat.id, text=text, reply_to_message_id=reply_to_message_id)
+async def check_restricted_channels_loop():
+    """ناظر: برای هر اتصال محدود یک worker نگه می‌دارد و با حذف/تغییر اتصال آن را متوقف یا بازسازی می‌کند."""
+    workers = {}  # conn_id -> ((source, destination), task)
+    while True:
+        try:
+            wanted = {conn_id: (source, destination) for conn_id, source, destination in await get_restricted_connections()}
+        except Exception as e:
+            logger.error(f"⛔️ خطا در خواندن اتصال‌های محدود: {e}")
+            wanted = {conn_id: channels for conn_id, (channels, _) in workers.items()}
+
+        for conn_id, (channels, task) in list(workers.items()):
+            if wanted.get(conn_id) != channels or task.done():
+                task.cancel()
+                del workers[conn_id]
+
+        for conn_id, channels in wanted.items():
+            if conn_id not in workers:
+                workers[conn_id] = (channels, asyncio.create_task(restricted_connection_worker(conn_id, *channels)))
+
+        await asyncio.sleep(RESTRICTED_SUPERVISOR_INTERVAL)
+
+# بک‌فیل خط لوله‌ای: خواندن تاریخچه، دانلود/پردازش و ارسال مراحل جدا با صف‌های محدود هستند
+backfill_backlog = {}  # connection_id -> probe() تعداد پیام در جریان (برای متریک‌ها)
+BACKFILL_PAGE_SIZE = 100
+BACKFILL_MAX_CONCURRENCY = int(os.getenv("BACKFILL_MAX_CONCURRENCY", 6))
+BACKFILL_WINDOW = int(os.getenv("BACKFILL_WINDOW", 50))  # حداکثر پیام بین خواندن و ارسال
+BACKFILL_COMMIT_EVERY = int(os.getenv("BACKFILL_COMMIT_EVERY", 50))  # پیشرفت هر N پیام در یک تراکنش ثبت می‌شود
+# اگر این مدت هیچ پیامی آماده نشود کار ناموفق ثبت می‌شود تا برای همیشه "در حال اجرا" نماند
+BACKFILL_STALL_TIMEOUT = float(os.getenv("BACKFILL_STALL_TIMEOUT", 1800))
+
+class AdaptiveLimiter:
+    """
+    سقف همزمانی که با FloodWait نصف می‌شود و با هر `recovery` موفقیت پشت سر هم یکی بالا می‌رود
+    (AIMD). کارها با `async with limiter:` وارد می‌شوند.
+    """
 
-                    elif msg.voice:
-                        voice_file = await user.download_media(msg.voice, in_memory=True)
-                        sent = await user.send_voice(chat_id=dest_chat.id, voice=voice_file, caption=caption, reply_to_message_id=reply_to_message_id)
+    def __init__(self, maximum, recovery=20):
+        self.maximum = maximum
+        self.limit = maximum
+        self.recovery = recovery
+        self._active = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def success(self):
+        self._successes += 1
+        if self._successes >= self.recovery and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+
+    def backoff(self):
+        self.limit = max(1, self.limit // 2)
+        self._successes = 0
+
+async def iter_history_ascending(client, chat_id, after_id=0, page_size=BACKFILL_PAGE_SIZE):
+    """
+    پیام‌های جدیدتر از after_id را صفحه به صفحه (هر صفحه یک لیست مرتب) از قدیم به جدید برمی‌گرداند
+    (get_chat_history فقط از جدید به قدیم می‌رود).
+    """
+    peer = await client.resolve_peer(chat_id)
+    while True:
+        try:
+            history = await client.invoke(raw.functions.messages.GetHistory(
+                peer=peer,
+                offset_id=after_id + 1,
+                offset_date=0,
+                add_offset=-page_size,
+                limit=page_size,
+                max_id=0,
+                min_id=after_id,
+                hash=0,
+            ))
+        except FloodWait as fw:
+            await asyncio.sleep(int(fw.value) + 1)
+            continue
 
-                    if sent:
-                        save_transferred_post(conn_id, msg.id, sent.id)
-                        add_activity_log(conn_id, "transfer", f"پست محدود از {source} به {destination} منتقل شد.")
-                        break  # فقط یک پیام منتقل شود در هر بررسی
+        messages = await utils.parse_messages(client, history, replies=0)
+        messages = sorted((m for m in messages if m.id > after_id), key=lambda m: m.id)
+        if not messages:
+            return
 
-            except Exception as e:
-                logger.error(f"⛔️ خطا در بررسی اتصال محدود {source} → {destination}: {e}")
+        yield messages
+        after_id = messages[-1].id
 
-async def backfill_connection(connection_id: int, batch_size: int = 200, from_start: bool = False) -> tuple[int, int]:
+async def backfill_connection(connection_id: int, batch_size: int = BACKFILL_PAGE_SIZE, from_start: bool = False,
+                              job_id: int | None = None) -> tuple[int, int]:
     """
-    همهٔ پیام‌های یک کانال را از ابتدا تا امروز منتقل می‌کند.
+    همهٔ پیام‌های یک کانال را از ابتدا تا امروز، به ترتیب، منتقل می‌کند.
     - اگر from_start=True باشد، last_scanned نادیده گرفته می‌شود تا واقعا از پیام 1 شروع کند.
-    - از duplicated با جدول transferred_posts جلوگیری می‌شود.
+    - اگر job_id داده شود، از cursor همان کار ادامه می‌دهد و checkpoint را همراه هر دسته ثبت می‌کند.
+    - از duplicated با جدول transferred_posts جلوگیری می‌شود (یک کوئری برای هر صفحهٔ تاریخچه).
+    - دانلود/پردازش چند پیام همزمان انجام می‌شود ولی ارسال فقط به ترتیب شناسهٔ پیام است؛
+      همزمانی با هر FloodWait کم می‌شود.
     خروجی: (تعداد منتقل‌شده، آخرین msg_id اسکن‌شده)
     """
-    row = get_connection_by_id(connection_id)
+    row = await get_connection_by_id(connection_id)
     if not row:
         raise ValueError("اتصال یافت نشد.")
     _, source, dest, _, last_scanned = row
 
-    src_chat = await user.get_chat(source)
-    dst_chat = await user.get_chat(dest)
-
-    async def _send_like_realtime(msg: Message, reply_to_message_id: int | None):
-        caption = replace_words(msg.caption, connection_id) if msg.caption else None
-        text = replace_words(msg.text, connection_id) if msg.text else None
-        watermark_text = get_connection_watermark(connection_id) or (f"@{dst_chat.username}" if getattr(dst_chat, "username", None) else "")
-
-        sent = None
-        if msg.photo:
-            photo_file = await user.download_media(msg.photo, in_memory=True)
-            image = Image.open(io.BytesIO(photo_file.getvalue())).convert("RGBA")
-            txt_layer = Image.new("RGBA", image.size, (255, 255, 255, 0))
-            draw = ImageDraw.Draw(txt_layer)
-            try:
-                font = ImageFont.truetype("Impact.ttf", 70)
-            except IOError:
-                font = ImageFont.load_default()
-            width, height = image.size
-            margin_x = 70 * 4
-            margin_y = 70 * 4
-            for x in range(0, width, margin_x):
-                for y in range(0, height, margin_y):
-                    draw.text((x, y), watermark_text, font=font, fill=(255, 255, 255, 128))
-            txt_layer = txt_layer.filter(ImageFilter.GaussianBlur(radius=1.5))
-            output = io.BytesIO()
-            Image.alpha_composite(image, txt_layer).convert("RGB").save(output, format="JPEG")
-            output.seek(0)
-            sent = await user.send_photo(dst_chat.id, output, caption=caption, reply_to_message_id=reply_to_message_id)
-
-        elif msg.animation:
-            animation_file = await user.download_media(msg.animation, in_memory=True)
-            try:
-                watermarked_gif_bytes = add_text_watermark_to_video(animation_file.getvalue(), watermark_text, is_gif=True)
-                sent = await user.send_animation(dst_chat.id, watermarked_gif_bytes, caption=text or "", parse_mode=ParseMode.HTML, reply_to_message_id=reply_to_message_id)
-            except Exception:
-                sent = await user.send_animation(dst_chat.id, animation_file, caption=text or "", parse_mode=ParseMode.HTML, reply_to_message_id=reply_to_message_id)
-
-        elif msg.video:
-            video_file = await user.download_media(msg.video, in_memory=True)
-            watermarked = add_text_watermark_to_video(video_file.getvalue(), watermark_text)
-            sent = await user.send_video(dst_chat.id, io.BytesIO(watermarked), caption=caption, reply_to_message_id=reply_to_message_id)
-
-        elif msg.sticker:
-            sent = await user.send_sticker(dst_chat.id, msg.sticker.file_id, reply_to_message_id=reply_to_message_id)
-
-        elif msg.voice:
-            voice_file = await user.download_media(msg.voice, in_memory=True)
-            sent = await user.send_voice(dst_chat.id, voice_file, caption=caption, reply_to_message_id=reply_to_message_id)
-
-        elif text:
-            sent = await user.send_message(dst_chat.id, text, reply_to_message_id=reply_to_message_id)
-
-        return sent
-
+    src_chat = await resolve_chat(user, source)
+    dst_chat = await resolve_chat(user, dest)
+    watermark_text = default_watermark_text(await get_connection_watermark(connection_id), getattr(dst_chat, "username", None))
+    plan = await get_transform_plan(connection_id, watermark_text, await is_connection_restricted(connection_id))
+
+    if job_id is not None:
+        job = await get_backfill_job(job_id)
+        start_after = job["cursor_message_id"] or 0
+        async for newest in user.get_chat_history(src_chat.id, limit=1):
+            await set_backfill_job_target(job_id, newest.id)
+    else:
+        start_after = 0 if from_start else (last_scanned or 0)
+
+    # ارسال‌های بک‌فیل (و taskهای فرزند) بعد از پیام‌های لحظه‌ای نوبت می‌گیرند
+    priority_token = send_priority.set(PRIORITY_BACKFILL)
+    limiter = AdaptiveLimiter(BACKFILL_MAX_CONCURRENCY)
+    flood_listener = lambda chat, seconds: limiter.backoff()
+    send_scheduler.add_listener(flood_listener)
+    window = asyncio.Semaphore(BACKFILL_WINDOW)
+    prepare_queue = asyncio.Queue()
+    results = {}  # seq -> (msg, "skip" | "ready" | "error", media/exception)
+    traces = {}   # seq -> PostTrace (یا None)
+    result_ready = asyncio.Condition()
+    fetched = {"count": 0, "done": False}
     transferred_count = 0
-    offset_id = 0
-    done_oldest = False
-    last_seen_id = 0 if from_start else (last_scanned or 0)
-
-    while True:
+    # نوشتن‌های دیتابیس تا BACKFILL_COMMIT_EVERY پیام جمع می‌شوند؛ sent_ids برای پیداکردن reply
+    # به پیام‌هایی است که هنوز در دیتابیس ثبت نشده‌اند
+    pending = {"transfers": [], "logs": [], "cursor": None, "job_cursor": None, "count": 0, "failed": 0}
+    sent_ids = {}
+    run_started = time.monotonic()
+    scanned_total = 0
+
+    async def _fetch():
         try:
-            batch = [m async for m in user.get_chat_history(src_chat.id, offset_id=offset_id, limit=batch_size)]
-        except FloodWait as fw:
-            await asyncio.sleep(int(fw.value) + 1)
-            continue
-
-        if not batch:
-            break
-
-        offset_id = batch[-1].id  # حرکت به قدیمی‌ترها
-        batch_sorted = list(sorted(batch, key=lambda m: m.id))  # قدیمی → جدید
-
-        for msg in batch_sorted:
-            # اگر از ابتدا می‌رویم، این شرط عملاً بی‌اثر است چون last_seen_id=0
-            if last_seen_id and msg.id <= last_seen_id:
-                continue
-
-            if get_destination_message_id(connection_id, msg.id):
-                update_last_scanned_message_id(connection_id, msg.id)
-                continue
-
-            reply_to_message_id = None
-            if msg.reply_to_message:
-                try:
-                    reply_to_message_id = get_destination_message_id(connection_id, msg.reply_to_message.id)
-                except Exception:
-                    reply_to_message_id = None
-
+            async for page in iter_history_ascending(user, src_chat.id, start_after, batch_size):
+                done = await get_transferred_message_ids(connection_id, [m.id for m in page])
+                for msg in page:
+                    await window.acquire()
+                    await prepare_queue.put((fetched["count"], msg, msg.id in done))
+                    fetched["count"] += 1
+        finally:
+            # حتی با خطای خواندن تاریخچه، ترتیب‌دهنده باید بیدار شود تا پیام‌های خوانده‌شده را بفرستد
+            # و بعد خطا را با await fetcher بالا بیاورد
+            async with result_ready:
+                fetched["done"] = True
+                result_ready.notify_all()
+
+    async def _prepare_worker():
+        while True:
+            seq, msg, already_sent = await prepare_queue.get()
+            metric_labels.set((connection_id, media_kind(msg)))
+            # trace در همین worker شروع و در ترتیب‌دهنده (بعد از ارسال) تمام می‌شود
+            trace = None if already_sent else start_trace(f"{media_kind(msg)} backfill conn={connection_id} msg_id={msg.id}")
             try:
-                sent = await _send_like_realtime(msg, reply_to_message_id)
-                if sent:
-                    save_transferred_post(connection_id, msg.id, sent.id)
-                    update_last_scanned_message_id(connection_id, msg.id)
-                    add_activity_log(connection_id, "transfer", f"بک‌فیل: {source} → {dest} | msg_id={msg.id}")
-                    transferred_count += 1
+                if already_sent:
+                    result = (msg, "skip", None)
+                elif plan["copy"]:
+                    # کپی سمت سرور؛ چیزی برای آماده‌سازی نیست
+                    result = (msg, "ready", None)
+                else:
+                    with span("prepare"):
+                        async with limiter:
+                            media = await prepare_media(user, msg, connection_id, watermark_text)
+                    limiter.success()
+                    result = (msg, "ready", media)
             except FloodWait as fw:
-                await asyncio.sleep(int(fw.value) + 1)
+                limiter.backoff()
+                result = (msg, "error", fw)
+            except Exception as e:
+                result = (msg, "error", e)
+            detach_trace(trace)
+            async with result_ready:
+                results[seq] = result
+                traces[seq] = trace
+                result_ready.notify_all()
+
+    async def _send(msg, media):
+        reply_to_message_id = None
+        if msg.reply_to_message_id:
+            reply_to_message_id = sent_ids.get(msg.reply_to_message_id)
+            if reply_to_message_id is None:
+                reply_to_message_id = await get_destination_message_id(connection_id, msg.reply_to_message_id)
+
+        if plan["copy"]:
+            return await copy_to_destination(user, msg, dst_chat.id, reply_to_message_id)
+
+        replacer = await get_word_replacer(connection_id)
+        caption = replacer.apply(msg.caption) if msg.caption else None
+        text = replacer.apply(msg.text) if msg.text else None
+        return await send_with_reuse_fallback(user, msg, dst_chat.id, media, caption, text, reply_to_message_id,
+                                              connection_id, watermark_text)
+
+    async def _flush():
+        if pending["count"] == 0:
+            return
+        batch = dict(pending)
+        pending.update(transfers=[], logs=[], cursor=None, job_cursor=None, count=0, failed=0)
+        checkpoint = None
+        if job_id is not None:
+            checkpoint = {
+                "job_id": job_id,
+                "cursor": batch["job_cursor"],
+                "scanned": batch["count"],
+                "transferred": len(batch["transfers"]),
+                "failed": batch["failed"],
+                "rate": scanned_total / max(time.monotonic() - run_started, 1e-6),
+            }
+        await save_transfer_progress(connection_id, batch["transfers"], batch["logs"], batch["cursor"], checkpoint)
+
+    async def _record(msg, sent=None, error=None):
+        nonlocal transferred_count, scanned_total
+        if sent:
+            pending["transfers"].append((msg.id, sent.id))
+            pending["logs"].append(("transfer", f"بک‌فیل: {source} → {dest} | msg_id={msg.id}"))
+            sent_ids[msg.id] = sent.id
+            transferred_count += 1
+        if error is not None:
+            metrics.record_failure(connection_id, media_kind(msg))
+            pending["logs"].append(("error", f"ارسال ناموفق در بک‌فیل msg_id={msg.id}: {error}"))
+            pending["failed"] += 1
+        else:
+            pending["cursor"] = msg.id
+        pending["job_cursor"] = msg.id
+        pending["count"] += 1
+        scanned_total += 1
+        if pending["count"] >= BACKFILL_COMMIT_EVERY:
+            await _flush()
+
+    workers = [asyncio.create_task(_prepare_worker()) for _ in range(BACKFILL_MAX_CONCURRENCY)]
+    fetcher = asyncio.create_task(_fetch())
+    next_seq = 0
+    # پیام‌های خوانده‌شده‌ای که هنوز ارسال نشده‌اند
+    backfill_backlog[connection_id] = lambda: fetched["count"] - next_seq
+    try:
+        while True:
+            async with result_ready:
                 try:
-                    sent = await _send_like_realtime(msg, reply_to_message_id)
+                    await asyncio.wait_for(
+                        result_ready.wait_for(lambda: next_seq in results or (fetched["done"] and next_seq >= fetched["count"])),
+                        BACKFILL_STALL_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"بک‌فیل {BACKFILL_STALL_TIMEOUT:g} ثانیه هیچ پیشرفتی نداشت") from None
+                if next_seq not in results:
+                    break
+                msg, status, payload = results.pop(next_seq)
+                trace = traces.pop(next_seq, None)
+
+            attach_trace(trace)
+            error = payload if status == "error" else None
+            try:
+                if status == "skip":
+                    await _record(msg)
+                elif status == "error":
+                    await _record(msg, error=payload)
+                else:
+                    started = time.monotonic()
+                    labels = metric_labels.set((connection_id, media_kind(msg)))
+                    try:
+                        with span("send"):
+                            try:
+                                sent = await _send(msg, payload)
+                            except FloodWait as fw:
+                                limiter.backoff()
+                                await asyncio.sleep(int(fw.value) + 1)
+                                sent = await _send(msg, payload)
+                    finally:
+                        metric_labels.reset(labels)
                     if sent:
-                        save_transferred_post(connection_id, msg.id, sent.id)
-                        update_last_scanned_message_id(connection_id, msg.id)
-                        add_activity_log(connection_id, "transfer", f"بک‌فیل: {source} → {dest} | msg_id={msg.id}")
-                        transferred_count += 1
-                except Exception as e:
-                    add_activity_log(connection_id, "error", f"ارسال ناموفق در بک‌فیل msg_id={msg.id}: {e}")
+                        metrics.record_transfer(connection_id, media_kind(msg), time.monotonic() - started,
+                                                media_size(msg), output_size(payload))
+                    await _record(msg, sent)
             except Exception as e:
-                add_activity_log(connection_id, "error", f"ارسال ناموفق در بک‌فیل msg_id={msg.id}: {e}")
+                error = e
+                await _record(msg, error=e)
+            finally:
+                finish_trace(trace, error)
+                if status == "ready":
+                    release_media(payload)
+                next_seq += 1
+                window.release()
+
+        # خطای خواندن تاریخچه (اگر بوده) اینجا بالا می‌آید
+        await fetcher
+    finally:
+        backfill_backlog.pop(connection_id, None)
+        send_scheduler.remove_listener(flood_listener)
+        send_priority.reset(priority_token)
+        # آنچه فرستاده شده حتی در صورت لغو یا خطا ثبت شود
+        await _flush()
+        fetcher.cancel()
+        for worker in workers:
+            worker.cancel()
+        for _, status, payload in results.values():
+            if status == "ready":
+                release_media(payload)
+
+    return transferred_count, await get_last_scanned_message_id(connection_id)
+
+# اجرای کارهای بک‌فیل در پس‌زمینه؛ job_id -> task
+backfill_tasks = {}
+
+def start_backfill_job(job_id: int, connection_id: int):
+    if job_id in backfill_tasks:
+        return backfill_tasks[job_id]
+    task = asyncio.create_task(run_backfill_job(job_id, connection_id))
+    backfill_tasks[job_id] = task
+    task.add_done_callback(lambda _: backfill_tasks.pop(job_id, None))
+    return task
+
+async def stop_backfill_job(job_id: int, status: str):
+    """وضعیت را (paused یا cancelled) ثبت و task را متوقف می‌کند؛ آخرین دسته قبل از توقف ثبت می‌شود."""
+    await set_backfill_job_status(job_id, status)
+    task = backfill_tasks.get(job_id)
+    if task:
+        task.cancel()
+        await asyncio.wait([task])
+
+async def run_backfill_job(job_id: int, connection_id: int):
+    try:
+        transferred, _ = await backfill_connection(connection_id, job_id=job_id)
+    except asyncio.CancelledError:
+        # وضعیت را کسی که لغو کرده ثبت کرده است
+        raise
+    except Exception as e:
+        logger.error(f"⛔️ کار بک‌فیل {job_id} ناموفق بود: {e}")
+        await set_backfill_job_status(job_id, "failed", str(e))
+        await add_activity_log(connection_id, "error", f"بک‌فیل {job_id} ناموفق بود: {e}")
+        text = f"❌ خطا در بک‌فیل #{job_id}:\n<code>{e}</code>"
+    else:
+        await set_backfill_job_status(job_id, "done")
+        text = f"✅ بک‌فیل #{job_id} تمام شد.\nپیام منتقل‌شده در این اجرا: {transferred}"
 
-        if len(batch) < batch_size:
-            done_oldest = True
-        if done_oldest:
-            break
+    try:
+        await send_scheduler.call(bot, ADMIN_ID, lambda: bot.send_message(ADMIN_ID, text, parse_mode=ParseMode.HTML))
+    except Exception as e:
+        logger.error(f"⛔️ ارسال گزارش بک‌فیل به ادمین ناموفق بود: {e}")
+
+async def resume_backfill_jobs():
+    """کارهایی که هنگام خاموش شدن در حال اجرا بودند از آخرین checkpoint ادامه پیدا می‌کنند."""
+    for job in await get_backfill_jobs(limit=1000, status="running"):
+        logger.info(f"ادامهٔ کار بک‌فیل {job['id']} از پیام {job['cursor_message_id']}")
+        start_backfill_job(job["id"], job["connection_id"])
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours} ساعت و {minutes} دقیقه"
+    if minutes:
+        return f"{minutes} دقیقه و {seconds} ثانیه"
+    return f"{seconds} ثانیه"
+
+BACKFILL_STATUS_LABELS = {
+    "running": "🟢 در حال اجرا",
+    "paused": "⏸ متوقف",
+    "cancelled": "⛔️ لغو شده",
+    "done": "✅ تمام شده",
+    "failed": "❌ ناموفق",
+}
+
+def render_backfill_job(job, source=None, dest=None):
+    text = f"📦 بک‌فیل #{job['id']}"
+    if source:
+        text += f" | {source} → {dest}"
+    text += f"\nوضعیت: {BACKFILL_STATUS_LABELS.get(job['status'], job['status'])}"
+    text += f"\nپیشرفت: پیام {job['cursor_message_id']} از {job['target_message_id'] or '?'}"
+    text += f"\nاسکن‌شده: {job['scanned_count']} | منتقل‌شده: {job['transferred_count']} | ناموفق: {job['failed_count']}"
+    if job["rate"]:
+        text += f"\nسرعت: {job['rate']:.1f} پیام در ثانیه"
+        remaining = (job["target_message_id"] or 0) - (job["cursor_message_id"] or 0)
+        if job["status"] == "running" and remaining > 0:
+            text += f"\nزمان باقی‌مانده (تقریبی): {format_duration(remaining / job['rate'])}"
+    if job["error"]:
+        text += f"\nخطا: {job['error']}"
+    return text
 
-    return transferred_count, get_last_scanned_message_id(connection_id)
+def backfill_job_keyboard(job):
+    buttons = []
+    if job["status"] == "running":
+        buttons.append([InlineKeyboardButton("⏸ توقف موقت", callback_data=f"bfpause_{job['id']}"),
+                        InlineKeyboardButton("⛔️ لغو", callback_data=f"bfcancel_{job['id']}")])
+    elif job["status"] == "paused":
+        buttons.append([InlineKeyboardButton("▶️ ادامه", callback_data=f"bfresume_{job['id']}"),
+                        InlineKeyboardButton("⛔️ لغو", callback_data=f"bfcancel_{job['id']}")])
+    buttons.append([InlineKeyboardButton("🔄 به‌روزرسانی", callback_data=f"bfjob_{job['id']}")])
+    buttons.append([InlineKeyboardButton("بازگشت", callback_data="backfill_jobs")])
+    return InlineKeyboardMarkup(buttons)
 
 # اجرای اصلی برنامه
 if __name__ == "__main__":
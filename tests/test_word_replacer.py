@@ -0,0 +1,56 @@
+import os
+import random
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# bot.py reads its credentials at import time; the tests never connect
+for key, value in (('API_ID', '1'), ('API_HASH', 'test'), ('BOT_TOKEN', '1:test'), ('ADMIN_ID', '1')):
+    os.environ.setdefault(key, value)
+
+sys.path.insert(0, str(ROOT))
+import bot  # noqa: E402
+
+
+def reference_replace(rules, text):
+    """leftmost-longest, one pass: what WordReplacer is expected to do"""
+    mapping = {}
+    for original, replacement in rules:
+        if original and original not in mapping:
+            mapping[original] = replacement
+    out, i = [], 0
+    while i < len(text):
+        match = max((w for w in mapping if text.startswith(w, i)), key=len, default=None)
+        if match:
+            out.append(mapping[match])
+            i += len(match)
+        else:
+            out.append(text[i])
+            i += 1
+    return ''.join(out)
+
+
+class WordReplacerTest(unittest.TestCase):
+    def test_rule_of_several_thousand_characters(self):
+        footer = ''.join(random.Random(1).choice('abcdefg کانال\n') for _ in range(5000))
+        replacer = bot.WordReplacer([(footer, '@mine'), ('hello', 'hi')])
+        self.assertEqual(replacer.apply(f'hello\n{footer}\nbye'), 'hi\n@mine\nbye')
+
+    def test_long_chain_of_prefix_rules(self):
+        # every rule is a prefix of the next one: deeply nested trie pattern
+        rules = [('a' * n, str(n)) for n in range(1, 1500)]
+        replacer = bot.WordReplacer(rules)
+        self.assertEqual(replacer.apply('a' * 1600), '1499' + '101')
+
+    def test_leftmost_longest_matches_reference(self):
+        rng = random.Random(6)
+        for _ in range(200):
+            rules = [(''.join(rng.choice('abc') for _ in range(rng.randint(1, 4))), str(i)) for i in range(rng.randint(1, 8))]
+            text = ''.join(rng.choice('abcd') for _ in range(40))
+            self.assertEqual(bot.WordReplacer(rules).apply(text), reference_replace(rules, text), (rules, text))
+
+
+if __name__ == '__main__':
+    unittest.main()